@@ -17,6 +17,9 @@ class AE(nn.Module):
 
 
 class AELoss(nn.Module):
+    # Averaged over the batch, so accumulated micro-batches are averaged too
+    reduction = 'mean'
+
     def __init__(self, bottleneck, norm_gamma):
         super(AELoss, self).__init__()
         self.logsoftmax = nn.LogSoftmax(1) # input is (B, Q, N)
@@ -28,12 +31,12 @@ class AELoss(nn.Module):
 
     def forward(self, quant_pred, target_wav):
 
-        log_pred = self.logsoftmax(quant_pred)
+        log_pred = self.logsoftmax(quant_pred.float())
         target_wav_gather = target_wav.long().unsqueeze(1)
         log_pred_target = torch.gather(log_pred, 1, target_wav_gather)
 
         rec_loss = - log_pred_target.mean()
-        ze_norm = (self.bottleneck.ze ** self.two).sum(dim=1).sqrt()
+        ze_norm = (self.bottleneck.ze.float() ** self.two).sum(dim=1).sqrt()
 
         norm_loss = self.norm_gamma * torch.abs(ze_norm - self.one).mean()
         total_loss = rec_loss + norm_loss
@@ -8,10 +8,15 @@ import data
 
 class State(object):
     '''Encapsulates full state of training'''
-    def __init__(self, step=0, model=None, dataset=None, optim=None):
+    def __init__(self, step=0, model=None, dataset=None, optim=None,
+            n_data_workers=0, prefetch_factor=2):
         self.model = model 
-        self.data_loader = data.WavLoader(dataset)
+        self.n_data_workers = n_data_workers
+        self.prefetch_factor = prefetch_factor
+        self.data_loader = self._make_data_loader(dataset)
         self.optim = optim
+        self.scaler = None
+        self.scaler_state = None
         self.step = step
         self.device = None
         self.torch_rng_state = torch.get_rng_state()
@@ -21,24 +26,36 @@ class State(object):
             self.torch_cuda_rng_states = None
 
 
-    def load(self, ckpt_file, dat_file):
-        sinfo = torch.load(ckpt_file)
+    def load(self, ckpt_file, dat_file=None):
+        """
+        Restore from ckpt_file.  dat_file is needed to continue training.
+        Without it, only the model and data settings are usable, as for
+        inference
+        """
+        sinfo = torch.load(ckpt_file, map_location='cpu')
 
         # This is the required order for model and data init 
         self.model = pickle.loads(sinfo['model'])
         dataset = pickle.loads(sinfo['dataset'])
-        dataset.load_data(dat_file)
+        if dat_file is not None:
+            dataset.load_data(dat_file)
         self.model.post_init(dataset)
         self.model.load_state_dict(sinfo['model_state_dict'])
-        dataset.post_init(self.model)
+        if dat_file is not None:
+            dataset.post_init(self.model)
 
-        self.data_loader = data.WavLoader(dataset)
+        self.data_loader = self._make_data_loader(dataset)
         self.optim = torch.optim.Adam(self.model.parameters())
         self.optim.load_state_dict(sinfo['optim'])
+        self.scaler_state = sinfo.get('scaler', None)
         self.step = sinfo['step']
         self.torch_rng_state = sinfo['rand_state']
         self.torch_cuda_rng_states = sinfo['cuda_rand_states']
 
+    def _make_data_loader(self, dataset):
+        return data.WavLoader(dataset, num_workers=self.n_data_workers,
+                prefetch_factor=self.prefetch_factor)
+
     def save(self, ckpt_file):
         # cur_device = self.device
         # self.to(torch.device('cpu'))
@@ -53,15 +70,17 @@ class State(object):
                 'model_state_dict': mstate_dict,
                 'dataset': dstate,
                 'optim': ostate,
+                'scaler': (self.scaler.state_dict() if self.scaler is not None
+                    else None),
                 'rand_state': torch.get_rng_state(),
                 'cuda_rand_states': (torch.cuda.get_rng_state_all() if
                     torch.cuda.is_available() else None)
                 }
-        if self.device.type == 'cuda':
-            torch.save(state, ckpt_file)
-        elif self.device.type == 'xla':
+        if self.device.type == 'xla':
             import torch_xla.core.xla_model as xm
             xm.save(state, ckpt_file)
+        else:
+            torch.save(state, ckpt_file)
         # self.to(cur_device)
 
     def to(self, device):
@@ -73,6 +92,15 @@ class State(object):
         self.optim.load_state_dict(ostate)
         self.device = device
 
+    def init_scaler(self, device_type, enabled):
+        """
+        Create the loss scaler for mixed precision training, restoring its
+        state if the checkpoint has one
+        """
+        self.scaler = torch.amp.GradScaler(device_type, enabled=enabled)
+        if enabled and self.scaler_state:
+            self.scaler.load_state_dict(self.scaler_state)
+
     def optim_checksum(self):
         return util.digest(self.optim.state_dict())
 
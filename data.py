@@ -8,7 +8,7 @@ import jitter
 from torch import nn
 import vconv
 import copy
-from collections import namedtuple
+from collections import namedtuple, deque
 
 import util
 import mfcc
@@ -25,51 +25,167 @@ def parse_catalog(sam_file):
         raise RuntimeError("Couldn't open or read samples file {}".format(sam_file))
     return catalog
 
-def convert(catalog, dat_file, n_quant, sample_rate=16000):
+def snd_file_path(dat_file):
     """
-    Convert all input data and save a dat file 
+    Path of the raw, flat sound file accompanying the index in dat_file
     """
-    import librosa
+    return dat_file + '.snd'
+
+def mfcc_file_path(dat_file):
+    """
+    Path of the optional, flat MFCC feature file accompanying dat_file
+    """
+    return dat_file + '.mfcc'
+
+
+def _snd_dtype(n_quant):
     if n_quant <= 2**8:
-        snd_dtype = np.uint8
+        return np.uint8
     elif n_quant <= 2**15:
-        snd_dtype = np.int16
+        return np.int16
     else:
-        snd_dtype = np.int32
+        return np.int32
+
+
+def _encode_file(snd_path, n_quant, sample_rate, mfcc_params):
+    """
+    Load and mu-law encode a single sound file, optionally computing its MFCC
+    and delta frames as (n_frames, n_chan).  Runs in a worker process of
+    convert, so it must stay a module-level function.
+    """
+    import librosa
+    snd, _ = librosa.load(snd_path, sr=sample_rate)
+    snd_mu = util.mu_encode_np(snd, n_quant).astype(_snd_dtype(n_quant))
+    if mfcc_params is None:
+        return snd_mu, None
+
+    # Features are computed from the encoded samples, exactly as
+    # VirtualBatch.populate would compute them from a slice
+    mfcc_proc = mfcc.ProcessWav(
+            sample_rate=mfcc_params['sample_rate'],
+            win_sz=mfcc_params['mfcc_win_sz'],
+            hop_sz=mfcc_params['mfcc_hop_sz'],
+            n_mels=mfcc_params['n_mels'],
+            n_mfcc=mfcc_params['n_mfcc'])
+    frames = mfcc_proc.func(torch.from_numpy(snd_mu))
+    return snd_mu, frames.t().numpy().astype(np.float32)
+
+
+def _bounded_imap(pool, fn, items, window):
+    """
+    Like pool.imap, but with at most window items submitted and not yet
+    consumed, so that results cannot pile up ahead of a slow consumer or a
+    slow early item
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) == window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(fn, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def convert(catalog, dat_file, n_quant, sample_rate=16000, n_workers=1,
+        report_interval=100, mfcc_params=None):
+    """
+    Convert all input data and save a dat file.  The mu-law encoded samples
+    are appended to a raw, flat file at snd_file_path(dat_file), and dat_file
+    itself holds only the compact index describing where each sample lives.
+
+    Files are decoded by a pool of n_workers processes.  Results are written
+    in catalog order, and at most 4 * n_workers files are submitted to the
+    pool ahead of the one being written, so that is the most held in memory.
+
+    If mfcc_params is given (a dict with the sample_rate, mfcc_win_sz,
+    mfcc_hop_sz, n_mels and n_mfcc arguments of Slice), the MFCC and delta
+    frames of each whole file are also written to mfcc_file_path(dat_file),
+    frame-major, so that Slice can read them instead of recomputing them.
+    """
+    import time
+    import multiprocessing
+    from functools import partial
 
-    n_mel_chan = None
+    snd_dtype = _snd_dtype(n_quant)
     speaker_ids = set(id for id,__ in catalog)
     speaker_id_map = dict((v,k) for k,v in enumerate(speaker_ids))
-    snd_data = np.empty((0), dtype=snd_dtype) 
-    samples = []
-
-    for (voice_id, snd_path) in catalog:
-        snd, _ = librosa.load(snd_path, sample_rate)
-        snd_mu = util.mu_encode_np(snd, n_quant).astype(snd_dtype)
-        wav_b = len(snd_data)
-        wav_e = wav_b + len(snd_mu)
-        snd_data.resize(wav_e)
-        snd_data[wav_b:wav_e] = snd_mu
-        samples.append(
-                SpokenSample(
-                    voice_index=speaker_id_map[voice_id], wav_b=wav_b,
-                    wav_e=wav_e, file_path=snd_path
-                    )
-                )
-        if len(samples) % 100 == 0:
-            print('Converted {} files of {}.'.format(len(samples),
-                len(catalog), file=stderr))
-            stderr.flush()
+    index = np.empty(len(catalog), dtype=index_dtype)
+    file_paths = [snd_path for __, snd_path in catalog]
+    encode_fn = partial(_encode_file, n_quant=n_quant, sample_rate=sample_rate,
+            mfcc_params=mfcc_params)
+    frame_b = np.empty(len(catalog), dtype=np.int64)
+    n_chan = None
+    frame_e = 0
+    wav_e = 0
+    t_beg = time.time()
+
+    def report(n_files):
+        elapsed = max(time.time() - t_beg, 1e-6)
+        print(('Converted {} files of {}.  {:.1f} files/s, {:.1f} sec audio/s, '
+            '{:.2f} MB/s').format(n_files, len(catalog), n_files / elapsed,
+                wav_e / sample_rate / elapsed,
+                wav_e * np.dtype(snd_dtype).itemsize / elapsed / 2**20),
+            file=stderr)
+        stderr.flush()
+
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        if pool is None:
+            results = map(encode_fn, file_paths)
+        else:
+            results = _bounded_imap(pool, encode_fn, file_paths,
+                    4 * n_workers)
+
+        mfcc_fh = None
+        if mfcc_params is not None:
+            mfcc_fh = open(mfcc_file_path(dat_file), 'wb')
+
+        with open(snd_file_path(dat_file), 'wb') as snd_fh:
+            for i, (snd_mu, frames) in enumerate(results):
+                snd_mu.tofile(snd_fh)
+                if mfcc_fh is not None:
+                    frames.tofile(mfcc_fh)
+                    frame_b[i] = frame_e
+                    frame_e += frames.shape[0]
+                    n_chan = frames.shape[1]
+                wav_b = wav_e
+                wav_e = wav_b + len(snd_mu)
+                index[i] = (speaker_id_map[catalog[i][0]], wav_b, wav_e)
+                if (i + 1) % report_interval == 0:
+                    report(i + 1)
+    finally:
+        if mfcc_fh is not None:
+            mfcc_fh.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(catalog) % report_interval != 0:
+        report(len(catalog))
 
     with open(dat_file, 'wb') as dat_fh:
         state = {
-                'samples': samples,
-                'snd_dtype': snd_dtype,
-                'snd_data': snd_data
+                'index': index,
+                'file_paths': file_paths,
+                'snd_dtype': np.dtype(snd_dtype).name,
+                'snd_len': wav_e
                 }
+        if mfcc_params is not None:
+            state['mfcc'] = {
+                    'params': dict(mfcc_params),
+                    'frame_b': frame_b,
+                    'n_frames': frame_e,
+                    'n_chan': n_chan
+                    }
         pickle.dump(state, dat_fh)
         
 
+# Compact, fixed-width index of the samples stored in the raw sound file 
+index_dtype = np.dtype([
+    ('voice_index', np.int32),
+    ('wav_b', np.int64),
+    ('wav_e', np.int64)
+    ])
 
 SpokenSample = namedtuple('SpokenSample', [
     'voice_index',   # index of the speaker for this sample
@@ -82,15 +198,21 @@ SpokenSample = namedtuple('SpokenSample', [
 
 
 class VirtualBatch(object):
-    def __init__(self, dataset):
+    fields = ('voice_index', 'jitter_index', 'wav_dec_input', 'mel_enc_input')
+
+    def __init__(self, dataset, pin_memory=False):
         super(VirtualBatch, self).__init__()
         ds = dataset
-        self.voice_index = torch.empty((ds.batch_size,), dtype=torch.long)
+        pin = { 'pin_memory': pin_memory }
+        self.voice_index = torch.empty((ds.batch_size,), dtype=torch.long,
+                **pin)
         self.jitter_index = torch.empty((ds.batch_size, ds.embed_len),
-                dtype=torch.long)
-        self.wav_dec_input = torch.empty((ds.batch_size, ds.dec_in_len))
+                dtype=torch.long, **pin)
+        self.wav_dec_input = torch.empty((ds.batch_size, ds.dec_in_len),
+                **pin)
         self.mel_enc_input = torch.empty((ds.batch_size, ds.num_mel_chan(),
-            ds.enc_in_mel_len)) 
+            ds.enc_in_mel_len), **pin) 
+        self.copied = None
 
     def __repr__(self):
         fmt = (
@@ -104,35 +226,101 @@ class VirtualBatch(object):
 
     def populate(self, dataset):
         """
-        sets the data for one sample in the batch
+        sets the data for all samples in the batch.  Windows are gathered at
+        once from strided views of the sound and MFCC data.
         """
         ds = dataset
         rg = torch.empty((ds.batch_size), dtype=torch.int64).cpu()
-        picks = rg.random_() % len(ds.in_start) 
+        picks = rg.random_() % len(ds.in_start_wav) 
         nz = ds.embed_len
         trim = ds.trim_dec_in
+        starts = ds.in_start_wav[picks]
+
+        # (n_snd - L + 1, L) view, where row s is the window starting at s
+        dec_windows = ds.snd_data.unfold(0, ds.dec_in_len, 1)
+        self.wav_dec_input.copy_(dec_windows[starts + int(trim[0])])
+        self.voice_index.copy_(ds.in_start_voice[picks])
+
+        if ds.use_mfcc_cache:
+            # (n_frames - L + 1, C, L) view, already in encoder layout
+            mel_windows = ds.mfcc_data.unfold(0, ds.enc_in_mel_len, 1)
+            self.mel_enc_input.copy_(mel_windows[ds.in_start_frame[picks]])
+        else:
+            wav_enc_batch = ds.snd_data.unfold(0, ds.enc_in_len, 1)[starts]
+            if ds.mfcc_frontend == 'torch':
+                # Featurize the whole batch at once, on the target device if
+                # set 
+                device = ds.target_device or torch.device('cpu')
+                self.mel_enc_input = ds.mfcc_proc_torch.func(
+                        wav_enc_batch.to(device))
+            else:
+                for b, wav_enc_input in enumerate(wav_enc_batch):
+                    self.mel_enc_input[b,...] = ds.mfcc_proc.func(wav_enc_input)
+
+        self.jitter_index[...] = ds.jitter.gen_indices_batch(ds.batch_size, nz)
+
+        self.mel_enc_input.div_(self.mel_enc_input.std(dim=(1,2)).view(-1, 1, 1))
+
+
+    def _map(self, fn):
+        """
+        Returns a copy of this batch with fn applied to each tensor.  The
+        copies are new leaves, keeping requires_grad from the originals.
+        """
+        vb = copy.copy(self)
+        vb.copied = None
+        with torch.no_grad():
+            for name in self.fields:
+                t = getattr(self, name)
+                setattr(vb, name, fn(t).requires_grad_(t.requires_grad))
+        return vb
+
+    def to(self, device, non_blocking=False):
+        """
+        Returns a copy of this batch on device.  This batch is left intact so
+        that, if its tensors are pinned, it may be refilled once the copy has
+        completed (see wait_copied)
+        """
+        return self._map(lambda t: t.to(device, non_blocking=non_blocking))
 
-        for b, wi in enumerate(picks):
-            s, voice_ind = ds.in_start[wi]
-            wav_enc_input = ds.snd_data[s:s + ds.enc_in_len]
-            # print('wav_enc_input.shape: {}, s: {}, ds.snd_data.shape: {}'.format(
-            #     wav_enc_input.shape, s, ds.snd_data.shape), file=stderr)
-            # stderr.flush()
+    def pin_memory(self):
+        """Called by DataLoader when pin_memory is set"""
+        return self._map(lambda t: t.pin_memory())
 
-            self.wav_dec_input[b,...] = wav_enc_input[trim[0]:trim[1]]
-            self.mel_enc_input[b,...] = ds.mfcc_proc.func(wav_enc_input)
-            self.voice_index[b] = voice_ind 
-            self.jitter_index[b,:] = \
-                    torch.tensor(ds.jitter.gen_indices(nz) + b * nz) 
-        self.mel_enc_input /= \
-            self.mel_enc_input.std(dim=(1,2)).unsqueeze(1).unsqueeze(1)
+    def record_stream(self, stream):
+        for name in self.fields:
+            t = getattr(self, name)
+            if t.is_cuda:
+                t.record_stream(stream)
 
+    def wait_copied(self):
+        """Block until any pending asynchronous copy from this batch is done"""
+        if self.copied is not None:
+            self.copied.synchronize()
+            self.copied = None
 
-    def to(self, device):
-        self.voice_index = self.voice_index.to(device)
-        self.jitter_index = self.jitter_index.to(device)
-        self.wav_dec_input = self.wav_dec_input.to(device)
-        self.mel_enc_input = self.mel_enc_input.to(device)
+
+class BatchTransfer(object):
+    """
+    Copies VirtualBatches from pinned host memory to a CUDA device on a
+    side stream.  The copy of batch N+1 then overlaps the kernels of batch N
+    still queued on the compute stream, which only waits for the copy when it
+    reaches batch N+1.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __call__(self, vbatch):
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            dev_vbatch = vbatch.to(self.device, non_blocking=True)
+            vbatch.copied = torch.cuda.Event()
+            vbatch.copied.record(self.stream)
+        compute_stream.wait_stream(self.stream)
+        # Memory allocated on the side stream is used on the compute stream
+        dev_vbatch.record_stream(compute_stream)
+        return dev_vbatch
 
 
 
@@ -159,6 +347,13 @@ class Slice(torch.utils.data.IterableDataset):
     def _initialize(self):
         super(Slice, self).__init__()
         self.target_device = None
+        self.mfcc_data = None
+        self.use_mfcc_cache = False
+        self.mfcc_frontend = 'librosa'
+        self.mfcc_proc_torch = None
+        self.transfer = None
+        self.host_batches = None
+        self.shard = (0, 1)
         self.__dict__.update(self.init_args)
         self.jitter = jitter.Jitter(self.jitter_prob) 
         self.mfcc_proc = mfcc.ProcessWav(
@@ -171,6 +366,7 @@ class Slice(torch.utils.data.IterableDataset):
                 stride=self.mfcc_hop_sz, parent=None, name='MFCC')
 
     def load_data(self, dat_file):
+        self.dat_file = dat_file
         try:
             with open(dat_file, 'rb') as dat_fh:
                 dat = pickle.load(dat_fh)
@@ -180,16 +376,65 @@ class Slice(torch.utils.data.IterableDataset):
             stderr.flush()
             exit(1)
 
-        self.samples = dat['samples']
-        self._load_sample_data(dat['snd_data'], dat['snd_dtype'])
-
-
-    def __setstate__(self, init_args):
-        self.init_args = init_args 
+        if 'snd_data' in dat:
+            # Older format, with the sound data pickled inline
+            self.samples = dat['samples']
+            self._load_sample_data(dat['snd_data'], dat['snd_dtype'])
+            return
+
+        self.samples = [
+                SpokenSample(voice_index=int(vi), wav_b=int(b), wav_e=int(e),
+                    file_path=p)
+                for (vi, b, e), p in zip(dat['index'], dat['file_paths'])
+                ]
+        self._map_sample_data(snd_file_path(dat_file), dat['snd_dtype'],
+                dat['snd_len'])
+        if 'mfcc' in dat:
+            self._map_mfcc_data(mfcc_file_path(dat_file), dat['mfcc'])
+
+
+    def __setstate__(self, state):
+        if 'init_args' not in state:
+            # Checkpoints written before the runtime state was saved
+            state = { 'init_args': state }
+        self.init_args = state['init_args'] 
         self._initialize()
 
+        # Sound data and geometry are restored lazily, in init_worker, since
+        # checkpoint.State.load supplies its own data file and model.
+        self.dat_file = state.get('dat_file', None)
+        self.geometry = state.get('geometry', None)
+        self.shard = state.get('shard', (0, 1))
+        if state.get('mfcc_frontend', 'librosa') != 'librosa':
+            self.set_mfcc_frontend(state['mfcc_frontend'])
+
     def __getstate__(self):
-        return self.init_args
+        return {
+                'init_args': self.init_args,
+                'dat_file': getattr(self, 'dat_file', None),
+                'geometry': getattr(self, 'geometry', None),
+                'mfcc_frontend': self.mfcc_frontend,
+                'shard': self.shard
+                }
+
+    def init_worker(self, worker_id, seed):
+        """
+        Called in each DataLoader worker process before it produces any
+        batches.  Torch's global generator in the worker is already seeded
+        with seed, which DataLoader derives from the main process generator
+        (and thus from the checkpointed state) plus worker_id.  numpy's
+        generator would otherwise be an identical copy in every forked
+        worker, so it is seeded here from the same value.
+        """
+        np.random.seed(seed % 2**32)
+        self.set_target_device(None)
+        if self.mfcc_proc_torch is not None:
+            self.mfcc_proc_torch.to(torch.device('cpu'))
+
+        if not hasattr(self, 'snd_data'):
+            # Started with 'spawn', so only the pickled state is present
+            self.load_data(self.dat_file)
+            self._init_geometry(self.geometry)
 
 
     def num_speakers(self):
@@ -200,34 +445,141 @@ class Slice(torch.utils.data.IterableDataset):
 
 
     def post_init(self, model):
-        self.trim_dec_in = model.trim_dec_in.numpy()
-        self.embed_len = model.embed_len
-        self.enc_in_len = model.enc_in_len
-        self.dec_in_len = model.dec_in_len
-        self.enc_in_mel_len = model.enc_in_mel_len
+        self._init_geometry({
+            'trim_dec_in': model.trim_dec_in.numpy(),
+            'embed_len': model.embed_len,
+            'enc_in_len': model.enc_in_len,
+            'dec_in_len': model.dec_in_len,
+            'enc_in_mel_len': model.enc_in_mel_len
+            })
+
+    def _init_geometry(self, geometry):
+        self.geometry = geometry
+        self.__dict__.update(geometry)
         
         w = self.window_batch_size
-        self.in_start = []
-        for sam in self.samples:
-            for b in range(sam.wav_b, sam.wav_e - self.enc_in_len, w):
-                self.in_start.append((b, sam.voice_index))
+        self.use_mfcc_cache = self.mfcc_data is not None
+        if self.use_mfcc_cache and w % self.mfcc_vc.stride != 0:
+            # Cached frames are aligned to the start of each file, so they
+            # only match slices starting a whole number of hops into it
+            print(('Warning: window batch size {} is not a multiple of the '
+                'MFCC hop size {}.  Not using cached MFCC features.').format(
+                    w, self.mfcc_hop_sz), file=stderr)
+            stderr.flush()
+            self.use_mfcc_cache = False
+
+        # Start sample, voice index and (if cached) MFCC start frame of
+        # every window batch
+        starts, voices, frames = [], [], []
+        for i, sam in enumerate(self.samples):
+            b = torch.arange(sam.wav_b,
+                    max(sam.wav_b, sam.wav_e - self.enc_in_len), w)
+            if self.use_mfcc_cache:
+                f = self.mfcc_frame_b[i] + (b - sam.wav_b) // self.mfcc_vc.stride
+                keep = f + self.enc_in_mel_len <= self.mfcc_frame_e[i]
+                b, f = b[keep], f[keep]
+                frames.append(f)
+            starts.append(b)
+            voices.append(torch.full_like(b, sam.voice_index))
+
+        self.in_start_wav = torch.cat(starts)
+        self.in_start_voice = torch.cat(voices)
+        self.in_start_frame = torch.cat(frames) if self.use_mfcc_cache else None
+
+        rank, n_shards = self.shard
+        if n_shards > 1:
+            self.in_start_wav = self.in_start_wav[rank::n_shards]
+            self.in_start_voice = self.in_start_voice[rank::n_shards]
+            if self.use_mfcc_cache:
+                self.in_start_frame = self.in_start_frame[rank::n_shards]
+
+    def set_shard(self, rank, n_shards):
+        """
+        Restrict batches to every n_shards'th window batch start, from rank,
+        so that data-parallel processes train on disjoint windows
+        """
+        self.shard = (rank, n_shards)
+        if getattr(self, 'geometry', None) is not None:
+            self._init_geometry(self.geometry)
 
 
     def _load_sample_data(self, snd_np, snd_dtype):
         """
         Populates self.snd_data
         """
-        if snd_dtype is np.uint8:
-            snd_data = torch.ByteTensor(snd_np)
-        elif snd_dtype is np.uint16:
-            snd_data = torch.ShortTensor(snd_np)
-        elif snd_dtype is np.int32:
-            snd_data = torch.IntTensor(snd_np)
-        self.snd_data = snd_data
+        self.snd_data = torch.from_numpy(np.asarray(snd_np, dtype=snd_dtype))
+
+    def _map_sample_data(self, snd_file, snd_dtype, snd_len):
+        """
+        Populates self.snd_data as a zero-copy view of the raw sound file.
+        The mapping is private and read-only in practice, so the pages are
+        shared through the page cache by all processes reading the file.
+        """
+        try:
+            snd_np = np.memmap(snd_file, dtype=np.dtype(snd_dtype), mode='c',
+                    shape=(snd_len,))
+        except (IOError, ValueError):
+            print('Could not map sound data file {}.'.format(snd_file),
+                    file=stderr)
+            stderr.flush()
+            exit(1)
+        self.snd_data = torch.from_numpy(snd_np)
+
+    def _map_mfcc_data(self, mfcc_file, mfcc_info):
+        """
+        Populates self.mfcc_data as a zero-copy (n_frames, n_chan) view of the
+        cached MFCC features, if they were computed with this Slice's settings
+        """
+        params = mfcc_info['params']
+        mismatch = [k for k, v in params.items() if self.init_args.get(k) != v]
+        if mismatch or mfcc_info['n_chan'] != self.num_mel_chan():
+            print(('Warning: cached MFCC features in {} were computed with '
+                'different settings ({}).  Ignoring them.').format(mfcc_file,
+                    ', '.join('{}={}'.format(k, params[k]) for k in mismatch)),
+                file=stderr)
+            stderr.flush()
+            return
+        try:
+            mfcc_np = np.memmap(mfcc_file, dtype=np.float32, mode='c',
+                    shape=(mfcc_info['n_frames'], mfcc_info['n_chan']))
+        except (IOError, ValueError):
+            print('Could not map MFCC data file {}.'.format(mfcc_file),
+                    file=stderr)
+            stderr.flush()
+            exit(1)
+        self.mfcc_data = torch.from_numpy(mfcc_np)
+        self.mfcc_frame_b = mfcc_info['frame_b'].tolist()
+        self.mfcc_frame_e = self.mfcc_frame_b[1:] + [mfcc_info['n_frames']]
 
 
     def set_target_device(self, target_device):
         self.target_device = target_device
+        self.host_batches = None
+        self.transfer = None
+        if target_device is not None and target_device.type == 'cuda':
+            self.transfer = BatchTransfer(target_device)
+        if self.mfcc_proc_torch is not None and target_device is not None:
+            self.mfcc_proc_torch.to(target_device)
+
+    def set_mfcc_frontend(self, frontend):
+        """
+        Choose how MFCC features are computed when they are not cached:
+        'librosa' computes them one slice at a time on the CPU with
+        mfcc.ProcessWav, 'torch' computes the whole batch at once with
+        mfcc.ProcessWavTorch, on the target device if one is set.
+        """
+        if frontend not in ('librosa', 'torch'):
+            raise ValueError('MFCC frontend must be one of "librosa" or "torch"')
+        self.mfcc_frontend = frontend
+        if frontend == 'torch' and self.mfcc_proc_torch is None:
+            self.mfcc_proc_torch = mfcc.ProcessWavTorch(
+                    sample_rate=self.sample_rate,
+                    win_sz=self.mfcc_win_sz,
+                    hop_sz=self.mfcc_hop_sz,
+                    n_mels=self.n_mels,
+                    n_mfcc=self.n_mfcc).float()
+            if self.target_device:
+                self.mfcc_proc_torch.to(self.target_device)
 
 
     def __iter__(self):
@@ -239,38 +591,81 @@ class Slice(torch.utils.data.IterableDataset):
         Random state is from torch.{get,set}_rng_state().  It is on the CPU,
         not GPU.
         """
-        vb = VirtualBatch(self)
-        vb.mel_enc_input.detach_()
-        vb.mel_enc_input.requires_grad_(False)
-        vb.populate(self)
-
-        if self.target_device:
-            vb.to(self.target_device)
-        vb.mel_enc_input.requires_grad_(True)
+        if self.transfer is None:
+            vb = VirtualBatch(self)
+            vb.populate(self)
+            if self.target_device:
+                vb = vb.to(self.target_device)
+        else:
+            vb = self._next_host_batch()
+            vb.populate(self)
+            vb = self.transfer(vb)
 
         return vb 
 
+    def _next_host_batch(self):
+        """
+        Returns the next of a pool of pinned host batches, once its previous
+        copy to the device has completed.  Two suffice, since a batch is only
+        refilled after the one following it has been handed out.
+        """
+        if self.host_batches is None:
+            self.host_batches = [VirtualBatch(self, pin_memory=True) for _ in
+                    range(2)]
+        vb = self.host_batches.pop(0)
+        self.host_batches.append(vb)
+        vb.wait_copied()
+        return vb
+
 
 class WavLoader(torch.utils.data.DataLoader):
     """
     Data loader which may be wrapped by a
     torch_xla.distributed.parallel_loader.
     This loader returns batches of tensors on cpu, optionally
-    pushing them to target_device if provided
+    pushing them to target_device if provided.
+
+    With num_workers > 0, batches are built in that many worker processes,
+    each keeping up to prefetch_factor batches ready.  Workers always produce
+    cpu tensors; the consumer is responsible for moving them to the device.
     """
     @staticmethod
     def ident(x):
         return x
 
-    def __init__(self, wav_dataset, target_device=None):
+    @staticmethod
+    def worker_init(worker_id):
+        info = torch.utils.data.get_worker_info()
+        info.dataset.init_worker(worker_id, info.seed)
+
+    def __init__(self, wav_dataset, target_device=None, num_workers=0,
+            prefetch_factor=2):
         self.target_device = target_device
+        worker_args = {}
+        if num_workers > 0:
+            worker_args = {
+                    'worker_init_fn': self.worker_init,
+                    'prefetch_factor': prefetch_factor,
+                    'persistent_workers': True
+                    }
         super(WavLoader, self).__init__(
                 dataset=wav_dataset,
                 batch_sampler=None,
-                collate_fn=self.ident
+                collate_fn=self.ident,
+                num_workers=num_workers,
+                **worker_args
                 )
 
     def set_target_device(self, target_device):
-        self.dataset.set_target_device(target_device)
-
+        """
+        With workers, batches arrive on the cpu.  For a cuda target they are
+        then pinned by DataLoader's pin memory thread so the consumer can copy
+        them asynchronously.
+        """
+        self.target_device = target_device
+        if self.num_workers == 0:
+            self.dataset.set_target_device(target_device)
+        else:
+            self.pin_memory = (target_device is not None and
+                    target_device.type == 'cuda')
 
@@ -0,0 +1,131 @@
+import json
+import queue
+import threading
+import torch
+
+
+class RingBuffer(object):
+    """
+    Device-resident circular buffer of the last n_slots rows pushed.  Rows
+    are flattened, and padded with fill or truncated to the width of the
+    first row.  Pushing never copies to the host.
+    """
+    def __init__(self, n_slots, fill=-1):
+        self.n_slots = n_slots
+        self.fill = fill
+        self.buf = None
+        self.pos = 0
+        self.count = 0
+
+    def push(self, row):
+        row = row.detach().flatten()
+        if self.buf is None:
+            self.buf = row.new_full((self.n_slots, row.nelement()), self.fill)
+        n = min(row.nelement(), self.buf.shape[1])
+        slot = self.buf[self.pos]
+        slot[:n] = row[:n]
+        slot[n:] = self.fill
+        self.pos = (self.pos + 1) % self.n_slots
+        self.count = min(self.count + 1, self.n_slots)
+
+    def contents(self):
+        """
+        A copy of the rows held, oldest first
+        """
+        if self.count < self.n_slots:
+            return self.buf[:self.count].clone()
+        return self.buf.roll(-self.pos, dims=0)
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+
+class JsonlWriter(object):
+    """
+    Appends records to a JSON-lines file from a background thread.  Tensors
+    are copied to the host and converted there, so submit does not wait for
+    the device.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, columns):
+        """
+        Write one record per row of columns, a dict of equal length lists or
+        tensors.  The tensors must not be modified afterwards
+        """
+        done = None
+        if any(isinstance(v, torch.Tensor) and v.is_cuda
+                for v in columns.values()):
+            columns = { k: v.to('cpu', non_blocking=True)
+                    if isinstance(v, torch.Tensor) else v
+                    for k, v in columns.items() }
+            done = torch.cuda.Event()
+            done.record()
+        self.queue.put((columns, done))
+
+    def _run(self):
+        with open(self.path, 'a') as fh:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                columns, done = item
+                if done is not None:
+                    done.synchronize()
+                columns = { k: v.tolist() if isinstance(v, torch.Tensor) else v
+                        for k, v in columns.items() }
+                for row in zip(*columns.values()):
+                    fh.write(json.dumps(dict(zip(columns.keys(), row))) + '\n')
+                fh.flush()
+
+    def close(self):
+        """
+        Write everything submitted so far, and stop the thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class VQDiagnostics(object):
+    """
+    Every interval steps, samples the code indices, encoder output norms,
+    codebook norms and code usage of a VQEMA bottleneck into ring buffers.
+    Each time n_slots samples have accumulated, they are written to path,
+    one JSON line per sample.  Steps in between do no work at all.
+    """
+    fields = ('min_ind', 'ze_norm', 'emb_norm', 'usage')
+
+    def __init__(self, path, interval, n_slots=100):
+        self.interval = interval
+        self.n_slots = n_slots
+        self.rings = { f: RingBuffer(n_slots) for f in self.fields }
+        self.steps = []
+        self.writer = JsonlWriter(path)
+
+    def record(self, step, bn):
+        if step % self.interval != 0:
+            return
+        for f, ring in self.rings.items():
+            ring.push(getattr(bn, f))
+        self.steps.append(step)
+        if len(self.steps) == self.n_slots:
+            self.flush()
+
+    def flush(self):
+        if len(self.steps) == 0:
+            return
+        columns = { 'step': self.steps }
+        columns.update({ f: ring.contents() for f, ring in self.rings.items() })
+        self.writer.submit(columns)
+        for ring in self.rings.values():
+            ring.clear()
+        self.steps = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import wave
+from sys import stderr
+from pprint import pprint
+import numpy as np
+import torch
+
+import checkpoint
+import data
+import parse_tools
+import util
+
+
+def load_mels(snd_path, dataset, n_quant, wings):
+    """
+    Normalized MFCC features (C, F) of one sound file, and its length in
+    samples.  As in training, they are computed from the mu-law codes of
+    preprocess.py and scaled as in VirtualBatch.populate.  The sound is
+    padded with silence by wings, the model's (left, right) receptive field
+    around the decoder input, plus one MFCC hop for frame alignment, so
+    that the conditioning covers every sample of the file.
+    """
+    import librosa
+    snd, _ = librosa.load(snd_path, sr=dataset.sample_rate)
+    padded = np.pad(snd, (wings[0], wings[1] + dataset.mfcc_hop_sz))
+    quant = torch.from_numpy(util.mu_encode_np(padded, n_quant))
+    mels = dataset.mfcc_proc.func(quant).float()
+    mels /= mels.std()
+    return mels, len(snd)
+
+
+def write_wav(wav_path, quant, n_quant, sample_rate):
+    snd = util.mu_decode_np(quant, n_quant)
+    pcm = (np.clip(snd, -1.0, 1.0) * 32767).astype('<i2')
+    with wave.open(wav_path, 'wb') as wav_fh:
+        wav_fh.setnchannels(1)
+        wav_fh.setsampwidth(2)
+        wav_fh.setframerate(sample_rate)
+        wav_fh.writeframes(pcm.tobytes())
+
+
+def conditioning(model, mels, speaker_ind, device, n_samples=None):
+    """
+    Decoder conditioning for the MFCC features of one file, as expected by
+    WaveNet.sample_streams.  If given, the conditioning is trimmed to
+    n_samples timesteps
+    """
+    encoding = model.encoder(mels.unsqueeze(0).to(device))
+    lc_sparse = model.bottleneck(encoding)
+    speaker_inds = torch.tensor([speaker_ind], device=device)
+    lc, cond_bias = model.decoder.incremental_cond(lc_sparse, speaker_inds)
+    return lc[0,:,:n_samples], cond_bias[0]
+
+
+def main():
+    parser = parse_tools.infer_parser()
+    opts = parser.parse_args()
+
+    print('Command line: ', ' '.join(sys.argv), file=stderr)
+    pprint(opts, stderr)
+    stderr.flush()
+
+    if opts.hwtype == 'GPU':
+        if not torch.cuda.is_available():
+            raise RuntimeError('GPU requested but not available')
+        device = torch.device('cuda')
+    elif opts.hwtype == 'CPU':
+        device = torch.device('cpu')
+    else:
+        raise RuntimeError(
+                ('Invalid device {} requested.  '
+                + 'Must be CPU or GPU').format(opts.hwtype))
+
+    state = checkpoint.State()
+    state.load(opts.ckpt_file)
+    model = state.model
+    model.to(device)
+    model.eval()
+    dataset = state.data_loader.dataset
+    n_quant = model.decoder.n_quant
+    n_speakers = model.decoder.cond.speaker_embedding.in_features
+
+    catalog = data.parse_catalog(opts.sam_file)
+    for speaker_ind, _ in catalog + [[opts.target_speaker, None]]:
+        if speaker_ind is not None and not 0 <= speaker_ind < n_speakers:
+            print('Speaker index {} out of range.  The model has {} '
+                    'speakers.'.format(speaker_ind, n_speakers), file=stderr)
+            exit(1)
+
+    os.makedirs(opts.out_dir, exist_ok=True)
+    generator = torch.Generator(device=device)
+    generator.manual_seed(opts.random_seed)
+
+    def all_conds():
+        for speaker_ind, snd_path in catalog:
+            if opts.target_speaker is not None:
+                speaker_ind = opts.target_speaker
+            mels, n_samples = load_mels(snd_path, dataset, n_quant,
+                    model.wings)
+            lc, cond_bias = conditioning(model, mels, speaker_ind, device,
+                    n_samples)
+            if lc.shape[1] < n_samples:
+                print('Warning: {} output is {} samples shorter than the '
+                        'input'.format(snd_path, n_samples - lc.shape[1]),
+                        file=stderr)
+            yield lc, cond_bias
+
+    # Files are decoded opts.n_batch at a time, each one starting as soon as
+    # another finishes
+    start = time.perf_counter()
+    total_snd = 0
+    for i, quant in model.decoder.sample_streams(all_conds(), opts.n_batch,
+            opts.temperature, generator):
+        snd_path = catalog[i][1]
+        base = os.path.splitext(os.path.basename(snd_path))[0]
+        out_path = os.path.join(opts.out_dir, base + '.wav')
+        write_wav(out_path, quant.cpu().numpy(), n_quant, dataset.sample_rate)
+        total_snd += len(quant)
+        elapsed = time.perf_counter() - start
+        secs = total_snd / dataset.sample_rate
+        print('Wrote {}.  {:.2f} sec audio in {:.2f} sec so far, real-time '
+                'factor {:.2f}'.format(out_path, secs, elapsed, elapsed / secs),
+                file=stderr)
+        stderr.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 class Jitter(object):
     """Time-jitter regularization.  With probability [p, (1-2p), p], replace
@@ -15,6 +16,7 @@ class Jitter(object):
         """
         super(Jitter, self).__init__()
         p, s = replace_prob, (1 - 2 * replace_prob)
+        self.p, self.s = p, s
         self.cond2d = np.tile([p, s, p], 9).reshape(3, 3, 3)
         self.cond2d[2][1] = [0, s/(p+s), p/(p+s)]
 
@@ -27,7 +29,39 @@ class Jitter(object):
         for t in range(2, win_size):
             p2 = index[t-2]
             p1 = index[t-1]
-            index[t] = np.random.choice([0,1,2], 1, False, self.cond2d[p1][p1])
+            index[t] = np.random.choice([0,1,2], 1, False, self.cond2d[p2][p1])[0]
         index[win_size] = 1
         index += np.arange(-1, win_size)
         return index[:-1]
+
+    def gen_indices_batch(self, n_batch, win_size, device=None, generator=None):
+        """
+        Same distribution as gen_indices, for n_batch independent windows at
+        once, computed with torch on device.  Returns (n_batch, win_size)
+        positions within each window.
+
+        All random draws are made up front, and x_t is a deterministic
+        function of its draw u_t and the context (x_(t-2), x_(t-1)).  Starting
+        from the unconstrained choice everywhere, re-applying that function to
+        all positions at once converges to the sequential result, since each
+        pass fixes at least one more position and the constraint rarely
+        chains.
+        """
+        p, s = self.p, self.s
+        u = torch.rand((n_batch, win_size), device=device, generator=generator)
+        # Inverse CDF of [p, s, p] and of [0, s/(p+s), p/(p+s)]
+        free = (u >= p).long() + (u >= p + s).long()
+        constrained = 1 + (u >= s / (p + s)).long()
+
+        index = free
+        index[:,:2] = 1
+        while True:
+            after_2_1 = (index[:,:-2] == 2) & (index[:,1:-1] == 1)
+            update = torch.where(after_2_1, constrained[:,2:], free[:,2:])
+            if torch.equal(update, index[:,2:]):
+                break
+            index[:,2:] = update
+
+        # The last position has no right neighbor, so it stays put instead
+        index += torch.arange(-1, win_size - 1, device=index.device)
+        return index.clamp_(max=win_size - 1)
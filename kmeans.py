@@ -0,0 +1,88 @@
+import torch
+
+
+def nearest(x, centroids, chunk_size=4096):
+    """
+    Index of the nearest row of centroids to each row of x, in chunks of
+    chunk_size rows
+    x: (M, D)
+    centroids: (K, D)
+    returns: (M)
+    """
+    return torch.cat([torch.cdist(chunk, centroids).argmin(dim=1) for chunk in
+        x.split(chunk_size)])
+
+
+def kmeans(x, k, n_iter=20, generator=None):
+    """
+    Lloyd's algorithm on the rows of x, starting from k distinct rows chosen
+    with generator.  Clusters that become empty restart from a random row.
+    x: (M, D)
+    returns: centroids (k, D) and the cluster of each row (M)
+    """
+    k = min(k, x.shape[0])
+    init = torch.randperm(x.shape[0], generator=generator)[:k]
+    centroids = x[init.to(x.device)].clone()
+    for _ in range(n_iter):
+        assign = nearest(x, centroids)
+        counts = torch.bincount(assign, minlength=k)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        empty = (counts == 0).nonzero()[:,0]
+        if len(empty) > 0:
+            rows = torch.randint(x.shape[0], (len(empty),), generator=generator)
+            centroids[empty] = x[rows.to(x.device)]
+    return centroids, nearest(x, centroids)
+
+
+def kmeans_pp(x, k, generator=None):
+    """
+    k-means++ seeding: k rows of x, each drawn with probability proportional
+    to its squared distance from the nearest row already drawn.
+    x: (M, D), with M >= k
+    returns: (k, D)
+    """
+    first = torch.randint(x.shape[0], (1,), generator=generator)
+    centroids = [x[first.item()]]
+    min_dist = ((x - centroids[0]) ** 2).sum(dim=1)
+    for _ in range(1, k):
+        # Chosen rows have zero weight, unless all rows coincide
+        weights = min_dist.cpu().double() if min_dist.sum() > 0 else \
+                torch.ones(x.shape[0], dtype=torch.double)
+        row = torch.multinomial(weights, 1, generator=generator).item()
+        centroids.append(x[row])
+        min_dist = torch.minimum(min_dist, ((x - x[row]) ** 2).sum(dim=1))
+    return torch.stack(centroids)
+
+
+def minibatch_kmeans(batches, k, n_samples, generator=None):
+    """
+    Mini-batch k-means (Sculley, "Web-Scale K-Means Clustering", 2010) on
+    the first n_samples vectors of an iterator of (M_i, D) tensors.
+    Centroids are seeded by kmeans_pp on the first k vectors or more, then
+    each batch moves its vectors' nearest centroids towards them, with a
+    rate of one over the number of vectors each centroid has received.  Only
+    the current batch is kept, on the device of the batches.
+    returns: (k, D)
+    """
+    seed, n_seen = [], 0
+    while n_seen < k:
+        seed.append(next(batches))
+        n_seen += len(seed[-1])
+    seed = torch.cat(seed)[:max(n_samples, k)]
+    centroids = kmeans_pp(seed, k, generator)
+    counts = centroids.new_zeros(k)
+
+    batch, n_seen = seed, 0
+    while True:
+        assign = nearest(batch, centroids)
+        n_new = torch.bincount(assign, minlength=k).to(counts.dtype)
+        counts += n_new
+        sums = torch.zeros_like(centroids).index_add_(0, assign, batch)
+        # c <- c + (sum of new x - n_new * c) / total count
+        centroids += (sums - n_new.unsqueeze(1) * centroids) / \
+                counts.clamp(min=1).unsqueeze(1)
+        n_seen += len(batch)
+        if n_seen >= n_samples:
+            return centroids
+        batch = next(batches)[:n_samples - n_seen]
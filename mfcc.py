@@ -21,6 +21,7 @@
 # n_mfcc (# of MFCCs to return)
 
 import torch
+from torch import nn
 import numpy as np
 import vconv 
 import math
@@ -37,20 +38,30 @@ class ProcessWav(object):
         self.vc = vconv.VirtualConv(filter_info=self.window_sz, stride=self.hop_sz,
                 parent=None, name=name)
 
+    def geometry(self):
+        """
+        Returns (left_pad, trim_left, trim_right): the number of zeros to
+        prepend to the input, and the number of output frames to drop from
+        either end.  See padding_notes.txt
+        """
+        adj = 1 if self.window_sz % 2 == 0 else 0
+        adj_l_wing_sz = self.vc.l_wing_sz + adj 
+
+        left_pad = adj_l_wing_sz % self.hop_sz
+        trim_left = adj_l_wing_sz // self.hop_sz
+        trim_right = self.vc.r_wing_sz // self.hop_sz
+        return left_pad, trim_left, trim_right
+
     def func(self, wav):
         import librosa
         # See padding_notes.txt 
         # NOTE: This function can't be executed on GPU due to the use of
-        # librosa.feature.mfcc
+        # librosa.feature.mfcc.  See ProcessWavTorch for a batched version
+        # that can.
         # C, T: n_mels, n_timesteps
         # Output: C, T
         # This assert doesn't seem to work when we just want to process an entire wav file
-        adj = 1 if self.window_sz % 2 == 0 else 0
-        adj_l_wing_sz = self.vc.l_wing_sz + adj 
-
-        left_pad = adj_l_wing_sz % self.hop_sz
-        trim_left = adj_l_wing_sz // self.hop_sz
-        trim_right = self.vc.r_wing_sz // self.hop_sz
+        left_pad, trim_left, trim_right = self.geometry()
 
         wav = wav.numpy()
         wav_pad = np.concatenate((np.zeros(left_pad), wav), axis=0) 
@@ -76,3 +87,121 @@ class ProcessWav(object):
 
         return torch.tensor(mfcc_and_derivatives)
 
+
+def _savgol_edge_matrix(width, order, polyorder=None):
+    """
+    Returns E: (width, width).  E[i] @ y[0:width] is the order'th derivative,
+    at position i, of the degree polyorder (default: order) polynomial
+    least-squares fit to y[0:width].  Row width // 2 is the Savitzky-Golay
+    filter used by librosa.feature.delta in the interior, and the first and
+    last width // 2 rows reproduce its mode='interp' handling of the edges.
+    """
+    polyorder = order if polyorder is None else polyorder
+    pos = np.arange(width, dtype=np.float64)
+    vander = pos[:,None] ** np.arange(polyorder + 1)[None,:]
+    deriv = np.zeros((width, polyorder + 1))
+    for p in range(order, polyorder + 1):
+        deriv[:,p] = math.factorial(p) // math.factorial(p - order) * \
+                pos ** (p - order)
+    return deriv @ np.linalg.pinv(vander)
+
+
+def _dct_ortho_matrix(n_out, n_in):
+    """
+    Returns the (n_out, n_in) type-II orthonormal DCT matrix, as used by
+    librosa.feature.mfcc
+    """
+    k = np.arange(n_out)[:,None]
+    n = np.arange(n_in)[None,:]
+    mat = np.cos(math.pi * k * (2 * n + 1) / (2 * n_in)) * math.sqrt(2.0 / n_in)
+    mat[0,:] *= math.sqrt(0.5)
+    return mat
+
+
+class ProcessWavTorch(nn.Module):
+    """
+    Same transform as ProcessWav.func (STFT -> mel filterbank -> log -> DCT ->
+    deltas, with the same padding and trimming), written with batched torch
+    operations so that a whole batch can be featurized in one call on any
+    device.  Matches librosa's defaults for librosa.feature.mfcc and
+    librosa.feature.delta (width 9, mode 'interp').
+    """
+    def __init__(self, sample_rate=16000, win_sz=400, hop_sz=160, n_mels=80,
+            n_mfcc=13, name=None, amin=1e-10, top_db=80.0, delta_width=9,
+            pad_mode='constant'):
+        super(ProcessWavTorch, self).__init__()
+        import librosa
+        self.proc = ProcessWav(sample_rate, win_sz, hop_sz, n_mels, n_mfcc, name)
+        self.n_out = self.proc.n_out
+        self.amin = amin
+        self.top_db = top_db
+        self.delta_width = delta_width
+        self.pad_mode = pad_mode
+
+        mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=win_sz,
+                n_mels=n_mels)
+        self.register_buffer('window', torch.hann_window(win_sz, periodic=True,
+            dtype=torch.float64))
+        self.register_buffer('mel_basis', torch.from_numpy(mel_basis).double())
+        self.register_buffer('dct', torch.from_numpy(
+            _dct_ortho_matrix(n_mfcc, n_mels)))
+        self.register_buffer('delta1', torch.from_numpy(
+            _savgol_edge_matrix(delta_width, 1)))
+        self.register_buffer('delta2', torch.from_numpy(
+            _savgol_edge_matrix(delta_width, 2)))
+
+    def delta(self, x, edge_mat):
+        """
+        x: (B, C, T)
+        edge_mat: (W, W) from _savgol_edge_matrix
+        returns: (B, C, T)
+        """
+        w = self.delta_width
+        h = w // 2
+        if x.shape[2] < w:
+            raise ValueError('Need at least {} frames to compute deltas, '
+                    'got {}'.format(w, x.shape[2]))
+        inner = torch.nn.functional.conv1d(x.flatten(0, 1).unsqueeze(1),
+                edge_mat[h].reshape(1, 1, w))
+        inner = inner.reshape(x.shape[0], x.shape[1], -1)
+        left = torch.matmul(x[:,:,:w], edge_mat[:h].t())
+        right = torch.matmul(x[:,:,-w:], edge_mat[h+1:].t())
+        return torch.cat((left, inner, right), dim=2)
+
+    def func(self, wav):
+        """
+        B, T: n_batch, n_timesteps
+        wav: (B, T) or (T)
+        returns: (B, C, F) or (C, F) in the dtype of the module's buffers
+        """
+        squeeze = wav.dim() == 1
+        if squeeze:
+            wav = wav.unsqueeze(0)
+        dtype = self.mel_basis.dtype
+        left_pad, trim_left, trim_right = self.proc.geometry()
+
+        wav_pad = torch.nn.functional.pad(wav.to(dtype), (left_pad, 0))
+        spec = torch.stft(wav_pad, n_fft=self.proc.window_sz,
+                hop_length=self.proc.hop_sz, window=self.window, center=True,
+                pad_mode=self.pad_mode, return_complex=True)
+        power = spec.real ** 2 + spec.imag ** 2
+        mel = torch.matmul(self.mel_basis, power)
+
+        # librosa.power_to_db with ref=1.0, per batch element
+        log_mel = 10.0 * torch.log10(torch.clamp(mel, min=self.amin))
+        if self.top_db is not None:
+            floor = log_mel.amax(dim=(1,2), keepdim=True) - self.top_db
+            log_mel = torch.max(log_mel, floor)
+
+        mfcc = torch.matmul(self.dct, log_mel)
+        mfcc_trim = mfcc[:,:,trim_left:-trim_right or None]
+        mfcc_and_derivatives = torch.cat((mfcc_trim,
+            self.delta(mfcc_trim, self.delta1),
+            self.delta(mfcc_trim, self.delta2)), dim=1)
+
+        if squeeze:
+            mfcc_and_derivatives = mfcc_and_derivatives.squeeze(0)
+        return mfcc_and_derivatives
+
+    def forward(self, wav):
+        return self.func(wav)
@@ -1,15 +1,18 @@
 # Full Autoencoder model
 from sys import stderr
 from hashlib import md5
-import numpy as np
+import time
+import contextlib
 from pickle import dumps
 import torch
 from torch import nn
+import torch.distributed as dist
 from torch.nn.modules import loss
-from scipy.cluster.vq import kmeans
 
 import model as ae
 import checkpoint
+import diagnostics
+import kmeans
 import ae_bn
 import data
 import mfcc
@@ -26,29 +29,25 @@ import wavenet as dec
 # from numpy import vectorize as np_vectorize
 class PreProcess(nn.Module):
     """
-    Perform one-hot encoding
+    Convert the input to integer codes for WaveNet's input embedding.
+    (This used to perform one-hot encoding.)
     """
     def __init__(self, pre_params, n_quant):
         super(PreProcess, self).__init__()
         self.n_quant = n_quant
-        self.register_buffer('quant_onehot', torch.eye(self.n_quant))
 
-    def one_hot(self, wav_compand):
-        """
-        wav_compand: (B, T)
-        B, Q, T: n_batch, n_quant, n_timesteps
-        returns: (B, Q, T)
-        """
-        wav_compand_tmp = wav_compand.long()
-        wav_one_hot = util.gather_md(self.quant_onehot, 0, wav_compand_tmp).permute(1,0,2)
-        return wav_one_hot
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints made with one-hot encoding have its identity matrix
+        state_dict.pop(prefix + 'quant_onehot', None)
+        super(PreProcess, self)._load_from_state_dict(state_dict, prefix,
+                *args, **kwargs)
 
     def forward(self, in_snd_slice):
         """
-        Converts the input to a one-hot format
+        in_snd_slice: (B, T) mu-law codes, of any dtype
+        returns: (B, T) long
         """
-        in_snd_slice_onehot = self.one_hot(in_snd_slice)
-        return in_snd_slice_onehot
+        return in_snd_slice.long()
 
 
 class AutoEncoder(nn.Module):
@@ -83,17 +82,22 @@ class AutoEncoder(nn.Module):
         self.encoder = enc.Encoder(n_in=n_mel_chan, parent_vc=None, **enc_params)
 
         bn_type = bn_params['type']
-        bn_extra = dict((k, v) for k, v in bn_params.items() if k != 'type')
     
         # In each case, the objective function's 'forward' method takes the
         # same arguments.
         if bn_type == 'vqvae':
-            self.bottleneck = vq_bn.VQ(**bn_extra, n_in=enc_params['n_out'])
+            self.bottleneck = vq_bn.VQ(n_in=enc_params['n_out'],
+                    n_out=bn_params['n_out'], vq_gamma=bn_params['vq_gamma'],
+                    vq_n_embed=bn_params['vq_n_embed'])
             self.objective = vq_bn.VQLoss(self.bottleneck)
 
         elif bn_type == 'vqvae-ema':
-            self.bottleneck = vqema_bn.VQEMA(**bn_extra, n_in=enc_params['n_out'],
-                    training=training)
+            self.bottleneck = vqema_bn.VQEMA(n_in=enc_params['n_out'],
+                    n_out=bn_params['n_out'], vq_gamma=bn_params['vq_gamma'],
+                    vq_ema_gamma=bn_params['vq_ema_gamma'],
+                    vq_n_embed=bn_params['vq_n_embed'], training=training,
+                    vq_index_lists=bn_params.get('vq_index_lists', 0),
+                    vq_index_probes=bn_params.get('vq_index_probes', 8))
             self.objective = vqema_bn.VQEMALoss(self.bottleneck)
 
         elif bn_type == 'vae':
@@ -104,7 +108,7 @@ class AutoEncoder(nn.Module):
                     free_nats=bn_params['free_nats']) 
 
         elif bn_type == 'ae':
-            self.bottleneck = ae_bn.AE(n_out=bn_extra['n_out'], n_in=enc_params['n_out'])
+            self.bottleneck = ae_bn.AE(n_out=bn_params['n_out'], n_in=enc_params['n_out'])
             self.objective = ae_bn.AELoss(self.bottleneck, 0.001) 
 
         else:
@@ -127,6 +131,7 @@ class AutoEncoder(nn.Module):
         """
         Initializes:
         self.enc_in_len
+        self.wings
         self.trim_ups_out
         self.trim_dec_out
         self.trim_dec_in
@@ -157,6 +162,9 @@ class AutoEncoder(nn.Module):
             di.sub[1] - uo.sub[0]], dtype=torch.long)
         self.trim_dec_out = torch.tensor([do.sub[0] - di.sub[0], do.sub[1] -
             di.sub[0]], dtype=torch.long)
+        # Input samples before and after the decoder input that the
+        # encoder needs.  infer.py pads whole files by these
+        self.wings = (di.sub[0] - ei.sub[0], ei.sub[1] - di.sub[1])
 
 
     def __getstate__(self):
@@ -174,40 +182,42 @@ class AutoEncoder(nn.Module):
 
     def init_codebook(self, data_source, n_samples):
         """
-        Initialize the VQ Embedding with samples from the encoder
+        Initialize the VQ Embedding by mini-batch k-means of n_samples
+        encoder outputs, computed on the model's device as they are needed.
+        Returns the time taken in seconds.
         """
         if self.bn_type not in ('vqvae', 'vqvae-ema'):
             raise RuntimeError('init_vq_embed only applies to the vqvae model type')
 
+        start = time.perf_counter()
         bn = self.bottleneck
-        e = 0
-        n_codes = bn.emb.shape[0]
-        k = bn.emb.shape[1]
-        samples = np.empty((n_samples, k), dtype=np.float) 
-        
-        with torch.no_grad():
-            while e != n_samples:
+
+        def encodings():
+            while True:
                 vbatch = next(data_source)
-                encoding = self.encoder(vbatch.mel_enc_input)
-                ze = self.bottleneck.linear(encoding)
-                ze = ze.permute(0, 2, 1).flatten(0, 1)
-                c = min(n_samples - e, ze.shape[0])
-                samples[e:e + c,:] = ze.cpu()[0:c,:]
-                e += c
+                ze = bn.linear(self.encoder(vbatch.mel_enc_input))
+                yield ze.permute(0, 2, 1).flatten(0, 1).float()
 
-        km, __ = kmeans(samples, n_codes)
-        bn.emb[...] = torch.from_numpy(km)
+        with torch.no_grad():
+            bn.emb[...] = kmeans.minibatch_kmeans(encodings(), bn.emb.shape[0],
+                    n_samples)
+            if dist.is_available() and dist.is_initialized():
+                # Data-parallel processes start from the codebook of rank 0
+                dist.broadcast(bn.emb, 0)
+            bn.codebook_init.fill_(True)
 
         if self.bn_type == 'vqvae-ema':
             bn.ema_numer = bn.emb * bn.ema_gamma_comp
             bn.ema_denom = bn.n_sum_ones * bn.ema_gamma_comp
+            bn.refresh_index()
+        return time.perf_counter() - start
         
     def checksum(self):
         """Return checksum of entire set of model parameters"""
         return util.tensor_digest(self.parameters())
         
 
-    def forward(self, mels, wav_onehot_dec, voice_inds, jitter_index):
+    def forward(self, mels, wav_dec, voice_inds, jitter_index):
         """
         B: n_batch
         M: n_mels
@@ -218,28 +228,27 @@ class AutoEncoder(nn.Module):
         Q: n_quant
         mels: (B, M, T)
         wav_compand: (B, T)
-        wav_onehot_dec: (B, T')  
+        wav_dec: (B, T') mu-law codes
         Outputs: 
         quant_pred (B, Q, N) # predicted wav amplitudes
         """
         encoding = self.encoder(mels)
         encoding_bn = self.bottleneck(encoding)
         self.encoding_bn = encoding_bn
-        quant = self.decoder(wav_onehot_dec, encoding_bn, voice_inds,
+        quant = self.decoder(wav_dec, encoding_bn, voice_inds,
                 jitter_index)
         return quant
 
     def run(self, vbatch):
         """
         Run the model on one batch, returning the predicted and
-        actual output
+        actual output.
         B, T, Q: n_batch, n_timesteps, n_quant
         Outputs:
         quant_pred: (B, Q, T) (the prediction from the model)
         wav_batch_out: (B, T) (the actual data from the same timesteps)
         """
-        wav_onehot_dec = self.preprocess(vbatch.wav_dec_input)
-        # grad = torch.autograd.grad(wav_onehot_dec, vbatch.wav_dec_input).data
+        wav_dec = self.preprocess(vbatch.wav_dec_input)
 
         # Slice each wav input
         trim = self.trim_dec_out
@@ -249,20 +258,65 @@ class AutoEncoder(nn.Module):
         #    wav_batch_out[b] = vbatch.wav_dec_input[b,sl_b:sl_e]
 
         # self.wav_batch_out = wav_batch_out
-        self.wav_onehot_dec = wav_onehot_dec
+        self.wav_dec = wav_dec
 
-        quant = self.forward(vbatch.mel_enc_input, wav_onehot_dec,
+        quant = self.forward(vbatch.mel_enc_input, wav_dec,
                 vbatch.voice_index, vbatch.jitter_index)
         # quant_pred[:,:,0] is a prediction for wav_compand_out[:,1] 
         return quant[...,:-1], wav_batch_out[...,1:]
 
 
+class TrainingLoss(nn.Module):
+    """
+    The model and its objective as one module, whose forward returns only
+    the loss.  DistributedDataParallel wraps this, so that parameters the
+    loss does not depend on, such as the decoder's under VQEMALoss, are
+    found unused.  The prediction and target are kept as attributes.
+    """
+    def __init__(self, model):
+        super(TrainingLoss, self).__init__()
+        self.model = model
+        self.quant = None
+        self.target = None
+
+    def forward(self, vbatch):
+        self.quant, self.target = self.model.run(vbatch)
+        return self.model.objective(self.quant, self.target)
+
+
 class GPULoaderIter(object):
-    def __init__(self, data_iter):
+    def __init__(self, data_iter, device=None):
         self.data_iter = data_iter
+        self.device = device
+        self.transfer = None
+        if device is not None and device.type == 'cuda':
+            self.transfer = data.BatchTransfer(device)
+        self.wait_time = 0.0
+        self.n_waits = 0
 
     def __next__(self):
-        return self.data_iter.__next__()[0]
+        start = time.perf_counter()
+        vb = self.data_iter.__next__()[0]
+        if self.device is not None and vb.wav_dec_input.device.type != \
+                self.device.type:
+            # The batch came from a data worker process
+            if self.transfer is None:
+                vb = vb.to(self.device)
+            else:
+                vb = self.transfer(vb)
+        self.wait_time += time.perf_counter() - start
+        self.n_waits += 1
+        return vb
+
+    def take_wait_time(self):
+        """
+        Mean time in seconds the training loop blocked waiting for a batch
+        since the last call
+        """
+        mean = self.wait_time / max(self.n_waits, 1)
+        self.wait_time = 0.0
+        self.n_waits = 0
+        return mean
 
 
 class TPULoaderIter(object):
@@ -284,6 +338,11 @@ class Metrics(object):
         self.learning_rates = dict(zip(opts.learning_rate_steps,
             opts.learning_rate_rates))
         self.opts = opts
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        self.ddp = None
+        self.loss_net = None
 
         if mode == 'new':
             torch.manual_seed(opts.random_seed)
@@ -305,11 +364,13 @@ class Metrics(object):
             model.post_init(dataset)
             dataset.post_init(model)
             optim = torch.optim.Adam(params=model.parameters(), lr=self.learning_rates[0])
-            self.state = checkpoint.State(0, model, dataset, optim)
+            self.state = checkpoint.State(0, model, dataset, optim,
+                    opts.n_data_workers, opts.prefetch_factor)
             self.start_step = self.state.step
 
         else:
-            self.state = checkpoint.State()
+            self.state = checkpoint.State(n_data_workers=opts.n_data_workers,
+                    prefetch_factor=opts.prefetch_factor)
             self.state.load(opts.ckpt_file, opts.dat_file)
             self.start_step = self.state.step
             # print('Restored model, data, and optim from {}'.format(opts.ckpt_file), file=stderr)
@@ -318,6 +379,11 @@ class Metrics(object):
             #print('Optim state: {}'.format(state.optim_checksum()))
             stderr.flush()
 
+        self.state.data_loader.dataset.set_mfcc_frontend(opts.mfcc_frontend)
+        if self.world_size > 1:
+            self.state.data_loader.dataset.set_shard(self.rank,
+                    self.world_size)
+
         if self.state.model.bn_type == 'vae':
             self.anneal_schedule = dict(zip(opts.bn_anneal_weight_steps,
                 opts.bn_anneal_weight_vals))
@@ -326,23 +392,45 @@ class Metrics(object):
         self.quant = None
         self.target = None
         self.softmax = torch.nn.Softmax(1) # input to this is (B, Q, N)
+        self.grad_stats = {}
+        self.amp_dtype = { 'fp32': None, 'bf16': torch.bfloat16,
+                'fp16': torch.float16 }[opts.precision]
 
-        if self.opts.hwtype == 'GPU':
+        # Restore the generator before starting the data iterator, since
+        # data worker seeds are drawn from it
+        self.state.init_torch_generator()
+        if self.world_size > 1:
+            # Distinct streams per process, reproducible from the checkpoint
+            seed = torch.randint(1 << 62, ()).item()
+            torch.manual_seed(seed + self.rank)
+
+        if self.opts.hwtype == 'CPU':
+            self.device = torch.device('cpu')
+            self.data_loader = self.state.data_loader
+            self.data_iter = GPULoaderIter(iter(self.data_loader))
+            self.optim_step_fn = self.scaled_optim_step
+        elif self.opts.hwtype == 'GPU':
             self.device = torch.device('cuda')
             self.data_loader = self.state.data_loader
             self.data_loader.set_target_device(self.device)
-            self.optim_step_fn = (lambda: self.state.optim.step(self.loss_fn))
-            self.data_iter = GPULoaderIter(iter(self.data_loader))
+            self.data_iter = GPULoaderIter(iter(self.data_loader), self.device)
+            self.optim_step_fn = self.scaled_optim_step
         else:
             import torch_xla.core.xla_model as xm
             import torch_xla.distributed.parallel_loader as pl
+            if self.amp_dtype == torch.float16:
+                raise RuntimeError('fp16 precision needs loss scaling, '
+                        'which is only supported with -hw CPU or GPU')
             self.device = xm.xla_device()
             self.data_loader = pl.ParallelLoader(self.state.data_loader, [self.device])
             self.data_iter = TPULoaderIter(self.data_loader, self.device)
             self.optim_step_fn = (lambda : xm.optimizer_step(self.state.optim,
                     optimizer_args={'closure': self.loss_fn}))
 
-        self.state.init_torch_generator()
+        # Only fp16 needs loss scaling.  Disabled, the scaler is a no-op
+        self.state.init_scaler(self.device.type,
+                enabled=self.amp_dtype == torch.float16)
+
         print('Done.', file=stderr)
         stderr.flush()
 
@@ -351,18 +439,41 @@ class Metrics(object):
         ss = self.state 
         ss.to(self.device)
         current_stats = {}
+        self.loss_net = TrainingLoss(ss.model)
+        if self.world_size > 1:
+            # Buffers are kept in sync by the model itself, as VQEMA does
+            self.ddp = nn.parallel.DistributedDataParallel(self.loss_net,
+                    broadcast_buffers=False, find_unused_parameters=True)
 
         # for resuming the learning rate 
         sorted_lr_steps = sorted(self.learning_rates.keys())
         lr_index = util.greatest_lower_bound(sorted_lr_steps, ss.step)
         ss.update_learning_rate(self.learning_rates[sorted_lr_steps[lr_index]])
 
-        sorted_as_steps = sorted(self.anneal_schedule.keys())
-        as_index = util.greatest_lower_bound(sorted_as_steps, ss.step)
-        ss.model.objective.update_anneal_weight(self.anneal_schedule[sorted_as_steps[as_index]])
+        if ss.model.bn_type == 'vae':
+            sorted_as_steps = sorted(self.anneal_schedule.keys())
+            as_index = util.greatest_lower_bound(sorted_as_steps, ss.step)
+            ss.model.objective.update_anneal_weight(self.anneal_schedule[sorted_as_steps[as_index]])
 
         if ss.model.bn_type in ('vqvae', 'vqvae-ema'):
-            ss.model.init_codebook(self.data_iter, 10000)
+            if ss.model.bottleneck.codebook_init:
+                print('Using the checkpointed codebook', file=stderr)
+            else:
+                secs = ss.model.init_codebook(self.data_iter, 10000)
+                print('Initialized codebook in {:.1f} seconds'.format(secs),
+                        file=stderr)
+            stderr.flush()
+
+        reseed_interval = 0
+        # Codes reseeded since the last progress message
+        n_reseeded = 0
+        diag = None
+        if ss.model.bn_type == 'vqvae-ema':
+            reseed_interval = self.opts.vq_reseed_interval
+            ss.model.objective.dead_threshold = self.opts.vq_reseed_threshold
+            if self.opts.diag_interval > 0 and self.rank == 0:
+                diag = diagnostics.VQDiagnostics(self.opts.diag_file,
+                        self.opts.diag_interval, self.opts.diag_slots)
 
         while ss.step < self.opts.max_steps:
             if ss.step in self.learning_rates:
@@ -376,7 +487,17 @@ class Metrics(object):
             if ss.model.bn_type == 'vqvae-ema' and ss.step == 10000:
                 ss.model.bottleneck.update_codebook()
 
-            if ss.step % self.opts.progress_interval == 0:
+            if diag is not None:
+                diag.record(ss.step, ss.model.bottleneck)
+
+            # Usage statistics need a full interval before judging codes dead
+            if (reseed_interval > 0 and ss.step % reseed_interval == 0 and
+                    ss.step != self.start_step):
+                n_reseeded = n_reseeded + \
+                        ss.model.bottleneck.reseed_dead_codes(
+                                self.opts.vq_reseed_threshold)
+
+            if ss.step % self.opts.progress_interval == 0 and self.rank == 0:
                 current_stats.update({
                         'step': ss.step,
                         'loss': loss,
@@ -384,7 +505,10 @@ class Metrics(object):
                         'tprb_m': self.avg_prob_target(),
                         # 'pk_d_m': avg_peak_dist
                         })
-                if ss.model.bn_type in ('vae'):
+                if isinstance(self.data_iter, GPULoaderIter):
+                    current_stats['data_wait'] = \
+                            self.data_iter.take_wait_time()
+                if ss.model.bn_type == 'vae':
                     current_stats['free_nats'] = ss.model.objective.free_nats
                     current_stats['anneal_weight'] = \
                             ss.model.objective.anneal_weight.item()
@@ -392,16 +516,23 @@ class Metrics(object):
                 if ss.model.bn_type in ('vqvae', 'vqvae-ema', 'ae', 'vae'):
                     current_stats.update(ss.model.objective.metrics)
                     current_stats.update(ss.model.encoder.metrics)
+                    current_stats.update(self.grad_stats)
+                if reseed_interval > 0:
+                    current_stats['reseeded'] = n_reseeded
+                    n_reseeded = 0
 
 
                 netmisc.print_metrics(current_stats, index, 100)
                 stderr.flush()
 
             if ((ss.step % self.opts.save_interval == 0 and ss.step !=
-                self.start_step)):
+                self.start_step and self.rank == 0)):
                 self.save_checkpoint()
             ss.step += 1
 
+        if diag is not None:
+            diag.close()
+
     def save_checkpoint(self):
         ckpt_file = self.ckpt_path.path(self.state.step)
         self.state.save(ckpt_file)
@@ -411,31 +542,96 @@ class Metrics(object):
 
     def run_batch(self):
         """
-        run the next batch through the model, populating quantities for the
-        loss.
+        run the next batch through the model and objective, returning the
+        loss and populating quantities for the metrics.
         """
         batch = next(self.data_iter)
-        quant_pred_snip, wav_compand_out_snip = self.state.model.run(batch) 
-        self.quant = quant_pred_snip
-        self.target = wav_compand_out_snip
-        self.probs = self.softmax(self.quant)
+        if self.grad_diag_step():
+            batch.mel_enc_input.requires_grad_(True)
+        with self.autocast():
+            loss = (self.loss_net if self.ddp is None else self.ddp)(batch)
+        self.quant = self.loss_net.quant
+        self.target = self.loss_net.target
+        self.probs = self.softmax(self.quant.float())
         self.mel_enc_input = batch.mel_enc_input
+        return loss
         
 
     def loss_fn(self):
-        """This is the closure needed for the optimizer"""
-        self.run_batch()
+        """
+        This is the closure needed for the optimizer.  Accumulates gradients
+        over opts.accum_steps batches, scaled according to the reduction of
+        the objective, and returns the loss of their combination.
+        """
+        objective = self.state.model.objective
+        n_accum = self.opts.accum_steps
+        # Mean objectives are averaged over the micro-batches, summed ones
+        # summed.  DistributedDataParallel averages gradients over
+        # processes, which summed objectives must undo in the backward pass
+        # only, so that the returned loss is that of this process
+        if objective.reduction == 'mean':
+            combine_scale = 1.0 / n_accum
+            micro_scale = combine_scale
+        else:
+            combine_scale = 1.0
+            micro_scale = float(self.world_size)
         self.state.optim.zero_grad()
-        loss = self.state.model.objective(self.quant, self.target)
-        inputs = (self.mel_enc_input, self.state.model.encoding_bn)
-        mel_grad, bn_grad = torch.autograd.grad(loss, inputs, retain_graph=True)
-        self.state.model.objective.metrics.update({
-            'mel_grad_sd': mel_grad.std(),
-            'bn_grad_sd': bn_grad.std()
-            })
-        # loss.backward(create_graph=True, retain_graph=True)
-        loss.backward()
+        total_loss = 0.0
+        for i in range(n_accum):
+            # Gradients are all-reduced only in the last backward pass
+            sync = self.ddp is None or i == n_accum - 1
+            with contextlib.nullcontext() if sync else self.ddp.no_sync():
+                loss = self.run_batch()
+                scaled_loss = self.state.scaler.scale(loss * micro_scale)
+                if i == 0 and self.grad_diag_step():
+                    self.hook_grad_stats(micro_scale)
+                # loss.backward(create_graph=True, retain_graph=True)
+                scaled_loss.backward()
+            total_loss += loss.detach() * combine_scale
+        if self.state.model.bn_type == 'vqvae-ema':
+            self.state.model.bottleneck.update_ema()
+        return total_loss
+
+    def grad_diag_step(self):
+        interval = self.opts.grad_diag_interval
+        return interval > 0 and self.state.step % interval == 0
+
+    def hook_grad_stats(self, loss_scale=1.0):
+        """
+        Record gradient statistics of the encoder input and bottleneck
+        output into self.grad_stats during the next backward pass, which is
+        of the objective times loss_scale
+        """
+        inv_scale = 1.0 / loss_scale
+        if self.state.scaler.is_enabled():
+            inv_scale /= self.state.scaler.get_scale()
+
+        def hook(name):
+            def record(grad):
+                self.grad_stats[name] = grad.detach().float().std() * inv_scale
+            return record
+
+        self.mel_enc_input.register_hook(hook('mel_grad_sd'))
+        self.state.model.encoding_bn.register_hook(hook('bn_grad_sd'))
+
+    def scaled_optim_step(self):
+        """
+        Optimizer step through the loss scaler, which skips the step if the
+        gradients overflowed.  The scaler does not support closures
+        """
+        loss = self.loss_fn()
+        self.state.scaler.step(self.state.optim)
+        self.state.scaler.update()
         return loss
+
+    def autocast(self):
+        """
+        Context running the model in opts.precision.  Numerically sensitive
+        parts of the model cast back to fp32 themselves
+        """
+        return torch.autocast(self.device.type,
+                dtype=self.amp_dtype or torch.float32,
+                enabled=self.amp_dtype is not None)
     
     def peak_dist(self):
         """Average distance between the indices of the peaks in pred and
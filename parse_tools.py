@@ -23,7 +23,20 @@ def train_parser():
     train.add_argument('--progress-interval', '-pi', type=int, default=1, metavar='INT',
             help='Print a progress message at this interval')
     train.add_argument('--hwtype', '-hw', type=str, default='GPU',
-            help='Harware target, one of CPU, GPU, or TPU')
+            help='Harware target, one of CPU, GPU, TPU or TPU-single')
+    train.add_argument('--n-procs', '-npr', type=int, metavar='INT',
+            default=1, help='With -hw CPU, number of data-parallel training '
+            'processes to start on this host')
+    train.add_argument('--n-nodes', '-nn', type=int, metavar='INT',
+            default=1, help='With -hw CPU, number of hosts, each running '
+            '--n-procs processes')
+    train.add_argument('--node-rank', '-nr', type=int, metavar='INT',
+            default=0, help='With -hw CPU, index of this host, from 0 to '
+            '--n-nodes - 1.  Host 0 writes the checkpoints')
+    train.add_argument('--master-addr', '-ma', type=str, metavar='STR',
+            default='localhost', help='Address of host 0, for --n-nodes > 1')
+    train.add_argument('--master-port', '-mp', type=int, metavar='INT',
+            default=29500, help='Free port on host 0 for process group setup')
     train.add_argument('--learning-rate-steps', '-lrs', type=int, nargs='+',
             metavar='INT', default=[0, 4e6, 6e6, 8e6],
             help='Learning rate starting steps to apply --learning-rate-rates')
@@ -31,6 +44,45 @@ def train_parser():
             metavar='FLOAT', default=[4e-4, 2e-4, 1e-4, 5e-5],
             help='Each of these learning rates will be applied at the '
             'corresponding value for --learning-rate-steps')
+    train.add_argument('--n-data-workers', '-ndw', type=int, metavar='INT',
+            default=0, help='Number of worker processes building batches. '
+            '0 builds them in the training process')
+    train.add_argument('--prefetch-factor', '-pf', type=int, metavar='INT',
+            default=2, help='Number of batches each data worker keeps ready')
+    train.add_argument('--mfcc-frontend', '-mff', type=str, metavar='STR',
+            default='librosa', choices=['librosa', 'torch'],
+            help='How to compute MFCC features not cached by preprocess.py: '
+            '"librosa" (per slice, CPU) or "torch" (batched, on the training device)')
+    train.add_argument('--accum-steps', '-as', type=int, metavar='INT',
+            default=1, help='Accumulate gradients over this many batches of '
+            '--n-batch before each optimizer step.  Steps, learning rate '
+            'schedules, checkpoints and the vqvae-ema codebook averages '
+            'count optimizer steps')
+    train.add_argument('--grad-diag-interval', '-gdi', type=int,
+            metavar='INT', default=0, help='Report the gradient standard '
+            'deviations at the encoder input and bottleneck output every this '
+            'many steps.  0 disables them')
+    train.add_argument('--precision', '-prc', type=str, metavar='STR',
+            default='fp32', choices=['fp32', 'bf16', 'fp16'],
+            help='Compute the forward pass under autocast in this precision. '
+            'fp16 also scales the loss to avoid gradient underflow')
+    train.add_argument('--vq-reseed-interval', '-vri', type=int,
+            metavar='INT', default=0, help='for vqvae-ema, every this many '
+            'steps, replace dead embedding vectors with recent encoder '
+            'outputs.  0 disables reseeding')
+    train.add_argument('--vq-reseed-threshold', '-vrt', type=float,
+            metavar='FLOAT', default=0.01, help='an embedding vector is dead '
+            'if its average use per step is below this fraction of the mean')
+    train.add_argument('--diag-interval', '-din', type=int, metavar='INT',
+            default=0, help='for vqvae-ema, sample the code indices, encoder '
+            'output norms, codebook norms and code usage every this many '
+            'steps, and log them to --diag-file.  0 disables them')
+    train.add_argument('--diag-slots', '-dsl', type=int, metavar='INT',
+            default=100, help='number of samples buffered on the device '
+            'between writes to --diag-file')
+    train.add_argument('--diag-file', '-dfl', type=str, metavar='STR',
+            default='diagnostics.jsonl', help='JSON-lines file the '
+            'diagnostics are appended to, one line per sample')
     train.add_argument('--random-seed', '-rnd', type=int, metavar='INT',
             default=2507,
             help='Random seed for weights initialization etc')
@@ -89,6 +141,13 @@ def cold_parser():
             help='beta multiplier for commitment loss term, Eq 3 from Chorowski et al.')
     cold.add_argument('--bn-vq-n-embed', '-vqn', type=int, metavar='INT', default=4096,
             help='number of embedding vectors, K, in section 3.1 of VQVAE paper')
+    cold.add_argument('--bn-vq-index-lists', '-vil', type=int, metavar='INT',
+            default=0, help='for vqvae-ema, find the nearest embedding vector '
+            'approximately, searching k-means partitions of the codebook.  '
+            'Number of partitions, or 0 for exact search.  See vq_bench.py')
+    cold.add_argument('--bn-vq-index-probes', '-vip', type=int, metavar='INT',
+            default=8, help='number of nearest partitions searched with '
+            '--bn-vq-index-lists')
 
 
     # Decoder architectural parameters
@@ -119,6 +178,14 @@ def cold_parser():
             'convolutions in each layer')
     cold.add_argument('--dec-n-global-embed', '-dng', type=int, metavar='INT',
             help='decoder number of global embedding channels')
+    cold.add_argument('--dec-fused', '-dfu', action='store_true', default=False,
+            help='use stacked signal/gate weights and a fused gated activation '
+            'in the decoder layers.  Same model, fewer kernels and less memory')
+    cold.add_argument('--dec-checkpoint-layers', '-dcl', type=int,
+            metavar='INT', default=0, help='Recompute the activations of '
+            'each run of this many decoder layers during the backward pass, '
+            'rather than keeping them.  Saves memory at the cost of about '
+            'one extra forward pass.  0 keeps all activations')
 
     # MFCC parameters
     cold.add_argument('--win-size', '-ws', type=int, metavar='INT',
@@ -145,6 +212,33 @@ def resume_parser():
     resume.prog += ' resume'
     return resume
 
+# Parser for infer.py
+def infer_parser():
+    infer = argparse.ArgumentParser()
+    infer.add_argument('--n-batch', '-nb', type=int, metavar='INT',
+            default=8, help='Number of files decoded together')
+    infer.add_argument('--target-speaker', '-ts', type=int, metavar='INT',
+            default=None, help='Speaker index to convert all files to.  '
+            'By default each file is resynthesized with its own speaker')
+    infer.add_argument('--temperature', '-t', type=float, metavar='FLOAT',
+            default=1.0, help='Sampling temperature.  0 picks the most '
+            'probable value at each timestep')
+    infer.add_argument('--hwtype', '-hw', type=str, default='GPU',
+            help='Hardware target, one of CPU or GPU')
+    infer.add_argument('--random-seed', '-rnd', type=int, metavar='INT',
+            default=2507, help='Random seed for sampling')
+    infer.add_argument('ckpt_file', type=str, metavar='CHECKPOINT_FILE',
+            help='Checkpoint file generated by train.py')
+    infer.add_argument('sam_file', type=str, metavar='SAMPLES_FILE',
+            help='File containing lines:\n'
+            + '<speaker_index1>\t/path/to/sample1.flac\n'
+            + '<speaker_index2>\t/path/to/sample2.flac\n'
+            + 'where speaker indices are those used by the model, from 0 to '
+            + 'n_speakers - 1')
+    infer.add_argument('out_dir', type=str, metavar='OUTPUT_DIR',
+            help='Directory in which to write a .wav file for each sample')
+    return infer
+
 def two_stage_parse(cold_parser, args=None):  
     '''wrapper for parse_args for overriding options from file'''
     default_opts = cold_parser.parse_args(args)
@@ -1,5 +1,6 @@
 from sys import stderr
 import argparse
+import os
 import data
 
 def make_parser():
@@ -8,6 +9,24 @@ def make_parser():
             default=256, help='Number of quantization levels for Mu-law companding')
     p.add_argument('--sample-rate', '-sr', type=int, metavar='INT',
             default=16000, help='Number of samples per second for parsing sound files')
+    p.add_argument('--n-workers', '-nw', type=int, metavar='INT',
+            default=os.cpu_count(), help='Number of processes decoding sound files')
+    p.add_argument('--report-interval', '-ri', type=int, metavar='INT',
+            default=100, help='Report progress and throughput after this many files')
+
+    # MFCC feature cache.  These must match the --pre-* settings used for
+    # training, otherwise the cache is ignored.
+    p.add_argument('--mfcc', '-mf', action='store_true', default=False,
+            help='Also store MFCC and delta features in {dat_file}.mfcc.  '
+            'They are used only if --n-win-batch is a multiple of the hop size')
+    p.add_argument('--mfcc-win-sz', '-wl', type=int, metavar='INT', default=400,
+            help='size of the MFCC window length in timesteps')
+    p.add_argument('--mfcc-hop-sz', '-hl', type=int, metavar='INT', default=160,
+            help='size of the hop length for MFCC preprocessing, in timesteps')
+    p.add_argument('--n-mels', '-nm', type=int, metavar='INT', default=80,
+            help='number of mel frequency values to calculate')
+    p.add_argument('--n-mfcc', '-nf', type=int, metavar='INT', default=13,
+            help='number of mfcc values to calculate')
 
     # positional arguments
     p.add_argument('sam_file', type=str, metavar='SAMPLES_FILE',
@@ -15,7 +34,8 @@ def make_parser():
             + '<id1>\t/path/to/sample1.flac\n'
             + '<id2>\t/path/to/sample2.flac\n')
     p.add_argument('dat_file', type=str, metavar='DAT_FILE',
-            help='Specify prefix for creating {dat_file}')
+            help='Index file to create.  Sound data is written to '
+            '{dat_file}.snd')
     return p
 
 def main():
@@ -26,7 +46,17 @@ def main():
     stderr.flush()
 
     catalog = data.parse_catalog(opts.sam_file)
-    data.convert(catalog, opts.dat_file, opts.n_quant, opts.sample_rate)
+    mfcc_params = None
+    if opts.mfcc:
+        mfcc_params = {
+                'sample_rate': opts.sample_rate,
+                'mfcc_win_sz': opts.mfcc_win_sz,
+                'mfcc_hop_sz': opts.mfcc_hop_sz,
+                'n_mels': opts.n_mels,
+                'n_mfcc': opts.n_mfcc
+                }
+    data.convert(catalog, opts.dat_file, opts.n_quant, opts.sample_rate,
+            opts.n_workers, opts.report_interval, mfcc_params)
     print('Wrote catalog to {}'.format(opts.dat_file),
             file=stderr)
     return 0
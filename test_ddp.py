@@ -0,0 +1,79 @@
+import os
+import tempfile
+from types import SimpleNamespace
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import data
+import model as ae
+
+# Two-process gloo smoke test of data-parallel training through
+# model.TrainingLoss, for the vqvae-ema objective, which leaves the decoder
+# out of the loss
+
+N_PROCS = 2
+
+
+def make_model():
+    ds = data.Slice(2, 50, 0.0, 16000, 400, 160, 80, 13)
+    bn_par = dict(type='vqvae-ema', n_out=16, vq_gamma=0.25,
+            vq_ema_gamma=0.99, vq_n_embed=32)
+    dec_par = dict(filter_sz=2, n_lc_out=16, lc_upsample_strides=[5, 4, 4, 4],
+            lc_upsample_filt_sizes=[25, 16, 16, 16], n_res=16, n_dil=16,
+            n_skp=12, n_post=16, n_quant=256, n_blocks=2, n_block_layers=4,
+            n_global_embed=4, n_speakers=3)
+    model = ae.AutoEncoder({}, {'n_out': 32}, bn_par, dec_par,
+            ds.num_mel_chan(), training=True)
+    model.post_init(ds)
+    return model
+
+
+def make_batch(model, n_batch=2):
+    return SimpleNamespace(
+            mel_enc_input=torch.randn(n_batch, model.init_args['n_mel_chan'],
+                model.enc_in_mel_len),
+            wav_dec_input=torch.randint(0, 256, (n_batch, model.dec_in_len)),
+            voice_index=torch.randint(0, 3, (n_batch,)),
+            jitter_index=torch.arange(model.embed_len).repeat(n_batch, 1))
+
+
+def run_rank(rank, init_file):
+    dist.init_process_group('gloo', init_method='file://' + init_file,
+            rank=rank, world_size=N_PROCS)
+    try:
+        torch.manual_seed(0)
+        model = make_model()
+        loss_net = ae.TrainingLoss(model)
+        ddp = torch.nn.parallel.DistributedDataParallel(loss_net,
+                broadcast_buffers=False, find_unused_parameters=True)
+        optim = torch.optim.SGD(model.parameters(), lr=0.1)
+        torch.manual_seed(1 + rank)
+        for step in range(3):
+            optim.zero_grad()
+            # The first micro-batch skips the gradient all-reduce
+            with ddp.no_sync():
+                ddp(make_batch(model)).backward()
+            ddp(make_batch(model)).backward()
+            model.bottleneck.update_ema()
+            optim.step()
+
+        # Processes see different data but stay identical
+        bn = model.bottleneck
+        for name, t in list(model.named_parameters()) + [('emb', bn.emb),
+                ('ema_numer', bn.ema_numer), ('usage', bn.usage)]:
+            ref = t.detach().clone()
+            dist.broadcast(ref, 0)
+            assert torch.equal(ref, t.detach()), name
+        assert all(p.grad is None for p in model.decoder.parameters())
+    finally:
+        dist.destroy_process_group()
+
+
+def test_vqema_data_parallel():
+    init_file = os.path.join(tempfile.mkdtemp(), 'init')
+    mp.spawn(run_rank, args=(init_file,), nprocs=N_PROCS)
+
+
+if __name__ == '__main__':
+    test_vqema_data_parallel()
+    print('Passed')
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+from collections import Counter
+import jitter
+
+# Compares the transition statistics of Jitter.gen_indices_batch with those
+# of the sequential Jitter.gen_indices
+
+def transitions(rows):
+    """
+    Counts of (x_(t-2), x_(t-1), x_t), where x is the choice in [0, 1, 2]
+    behind each jittered index
+    """
+    counts = Counter()
+    for r in rows:
+        x = np.asarray(r) - np.arange(-1, len(r) - 1)
+        for t in range(2, len(x)):
+            counts[tuple(x[t-2:t+1])] += 1
+    return counts
+
+
+def conditionals(counts):
+    """P(x_t | x_(t-2), x_(t-1)) as {context: [p0, p1, p2]}"""
+    probs = {}
+    for p2 in range(3):
+        for p1 in range(3):
+            n = [counts[(p2, p1, x)] for x in range(3)]
+            if sum(n) > 0:
+                probs[(p2, p1)] = np.array(n) / sum(n)
+    return probs
+
+
+def test_batch_matches_sequential():
+    jit = jitter.Jitter(0.12)
+    n_batch, win_size = 1000, 60
+    np.random.seed(1)
+    torch.manual_seed(1)
+    seq = conditionals(transitions(jit.gen_indices(win_size)
+        for _ in range(n_batch)))
+    bat = conditionals(transitions(jit.gen_indices_batch(n_batch,
+        win_size).numpy()))
+
+    for ctx in seq:
+        expected = jit.cond2d[ctx[0]][ctx[1]]
+        assert np.abs(seq[ctx] - expected).max() < 0.05, ctx
+        assert np.abs(bat[ctx] - expected).max() < 0.05, ctx
+        assert np.abs(seq[ctx] - bat[ctx]).max() < 0.05, ctx
+
+
+def test_no_three_in_a_row():
+    jit = jitter.Jitter(0.3)
+    index = jit.gen_indices_batch(500, 200)
+    assert (index[:,:-2] == index[:,1:-1]).logical_and(
+            index[:,1:-1] == index[:,2:]).sum() == 0
+    assert (index[:,:2] == torch.arange(2)).all()
+
+
+if __name__ == '__main__':
+    test_batch_matches_sequential()
+    test_no_three_in_a_row()
+    print('Passed')
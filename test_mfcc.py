@@ -0,0 +1,48 @@
+import torch
+import numpy as np
+import mfcc
+
+# Checks that the batched torch MFCC frontend reproduces the librosa one.
+# Inputs are mu-law encoded samples, as stored by preprocess.py
+
+def random_wav(n_batch, n_timesteps, seed=0):
+    rs = np.random.RandomState(seed)
+    return torch.from_numpy(rs.randint(0, 256, size=(n_batch, n_timesteps))
+            .astype(np.uint8))
+
+
+def compare(n_batch, n_timesteps, win_sz=400, hop_sz=160, dtype=torch.float64):
+    ref_proc = mfcc.ProcessWav(win_sz=win_sz, hop_sz=hop_sz)
+    torch_proc = mfcc.ProcessWavTorch(win_sz=win_sz, hop_sz=hop_sz).to(dtype)
+    wav = random_wav(n_batch, n_timesteps)
+    ref = torch.stack([ref_proc.func(w) for w in wav])
+    out = torch_proc.func(wav)
+    assert out.shape == ref.shape, 'shape {} != {}'.format(out.shape, ref.shape)
+    return (out.double() - ref).abs().max().item()
+
+
+def test_batch_matches_librosa():
+    for n_timesteps in (2146, 5000, 8191):
+        assert compare(3, n_timesteps) < 1e-8
+
+
+def test_float32_matches_librosa():
+    assert compare(2, 5000, dtype=torch.float32) < 1e-2
+
+
+def test_odd_window():
+    assert compare(2, 4000, win_sz=401) < 1e-8
+
+
+def test_single_wav():
+    proc = mfcc.ProcessWavTorch()
+    wav = random_wav(1, 3000)
+    assert (proc.func(wav[0]) - proc.func(wav)[0]).abs().max().item() == 0
+
+
+if __name__ == '__main__':
+    test_batch_matches_librosa()
+    test_float32_matches_librosa()
+    test_odd_window()
+    test_single_wav()
+    print('Passed')
@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import torch
+import diagnostics
+import kmeans
+import vqema_bn
+import vq_index
+
+# Checks the matmul-based nearest code search against the brute force
+# distances over all (z, code) pairs
+
+def brute_force(z, emb, scaled):
+    diff = z.unsqueeze(1) - emb.unsqueeze(2).unsqueeze(0) # B, K, D, N
+    if scaled:
+        dist = vqema_bn.scaled_l2_norm(z.unsqueeze(1),
+                emb.unsqueeze(2).unsqueeze(0))
+    else:
+        dist = (diff ** 2).sum(dim=2)
+    return dist.min(dim=1)[1]
+
+
+def test_nearest_codes():
+    torch.manual_seed(0)
+    z = torch.randn(3, 8, 50)
+    emb = torch.randn(100, 8)
+    for scaled in (False, True):
+        ref = brute_force(z, emb, scaled)
+        for chunk_size in (1024, 7):
+            out = vq_index.nearest_codes(z, emb, scaled, chunk_size)
+            assert torch.equal(out, ref), (scaled, chunk_size)
+
+
+def test_nearest_codes_exact_match():
+    # Codes that equal z must be found despite cancellation in the expansion
+    torch.manual_seed(0)
+    emb = torch.randn(64, 16) * 10
+    inds = torch.randint(0, 64, (2, 20))
+    z = emb[inds].permute(0, 2, 1)
+    for scaled in (False, True):
+        assert torch.equal(vq_index.nearest_codes(z, emb, scaled), inds)
+
+
+def test_ivf_index():
+    torch.manual_seed(0)
+    z = torch.randn(3, 8, 50)
+    emb = torch.randn(200, 8)
+    for scaled in (False, True):
+        exact = vq_index.nearest_codes(z, emb, scaled)
+        # Probing every list is exhaustive
+        index = vq_index.IVFIndex(8, 8, scaled)
+        index.build(emb)
+        assert torch.equal(index.search(z), exact)
+        index = vq_index.IVFIndex(8, 2, scaled)
+        index.build(emb)
+        assert (index.search(z) == exact).float().mean() > 0.7
+
+
+def test_minibatch_kmeans():
+    # Well separated clusters, streamed in batches, are each found
+    torch.manual_seed(0)
+    centers = torch.randn(16, 8) * 10
+    batches = (centers[torch.randint(0, 16, (100,))] + torch.randn(100, 8) * 0.1
+            for _ in range(100))
+    centroids = kmeans.minibatch_kmeans(batches, 16, 3000)
+    assert centroids.shape == (16, 8)
+    assert torch.cdist(centers, centroids).min(dim=1)[0].max() < 0.5
+
+
+def test_reseed_dead_codes():
+    torch.manual_seed(0)
+    vq = vqema_bn.VQEMA(8, 4, 0.25, 0.9, 16, training=True)
+    # Encodings all near one code, so the others are never used
+    vq.emb[...] = torch.randn(16, 4) * 10
+    vq.linear.weight.data = torch.eye(4, 8).unsqueeze(2)
+    z = vq.emb[3].repeat(2).view(1, 8, 1) + torch.randn(2, 8, 20) * 0.1
+    for _ in range(5):
+        vq(z)
+        vq.update_ema()
+    dead = vq.dead_codes(0.01)
+    assert dead.sum().item() == 15 and not dead[3]
+    assert vq.reseed_dead_codes(0.01).item() == 15
+    assert not vq.dead_codes(0.01).any()
+    # Reseeded codes are distinct recent encoder outputs
+    recent = vq.recent_ze[:vq.n_recent]
+    new = vq.emb[torch.arange(16) != 3]
+    assert torch.cdist(new, recent).min(dim=1)[0].max() == 0
+    assert new.unique(dim=0).shape[0] == 15
+
+
+def test_diagnostics_log():
+    torch.manual_seed(0)
+    vq = vqema_bn.VQEMA(8, 4, 0.25, 0.9, 16, training=True)
+    path = os.path.join(tempfile.mkdtemp(), 'diag.jsonl')
+    diag = diagnostics.VQDiagnostics(path, interval=2, n_slots=3)
+    inds = {}
+    for step in range(10):
+        vq(torch.randn(2, 8, 5))
+        vq.update_ema()
+        inds[step] = vq.min_ind.flatten().tolist()
+        diag.record(step, vq)
+    diag.close()
+    with open(path) as fh:
+        recs = [json.loads(line) for line in fh]
+    assert [r['step'] for r in recs] == [0, 2, 4, 6, 8]
+    for r in recs:
+        assert r['min_ind'] == inds[r['step']]
+        assert len(r['ze_norm']) == 10 and len(r['emb_norm']) == 16
+
+
+def test_ema_per_step():
+    # Accumulating micro-batches gives the same averages as one batch
+    torch.manual_seed(0)
+    whole = vqema_bn.VQEMA(8, 4, 0.25, 0.9, 16, training=True)
+    split = vqema_bn.VQEMA(8, 4, 0.25, 0.9, 16, training=True)
+    split.load_state_dict(whole.state_dict())
+    z = torch.randn(4, 8, 5)
+    whole(z)
+    whole.update_ema()
+    split(z[:2])
+    split(z[2:])
+    split.update_ema()
+    for name in ('ema_numer', 'ema_denom', 'usage'):
+        assert torch.allclose(getattr(whole, name), getattr(split, name),
+                atol=1e-6), name
+
+
+if __name__ == '__main__':
+    test_nearest_codes()
+    test_nearest_codes_exact_match()
+    test_ivf_index()
+    test_minibatch_kmeans()
+    test_reseed_dead_codes()
+    test_diagnostics_log()
+    test_ema_per_step()
+    print('Passed')
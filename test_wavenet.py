@@ -0,0 +1,139 @@
+import torch
+import data
+import model as ae
+
+# Checks that incremental generation in wavenet.WaveNet reproduces the
+# teacher-forced forward pass, once its queues hold a full receptive field
+
+def make_model(n_batch=2, n_win=100, fused=False):
+    ds = data.Slice(n_batch, n_win, 0.0, 16000, 400, 160, 80, 13)
+    dec_par = dict(filter_sz=2, n_lc_out=16, lc_upsample_strides=[5, 4, 4, 4],
+            lc_upsample_filt_sizes=[25, 16, 16, 16], n_res=16, n_dil=16,
+            n_skp=12, n_post=16, n_quant=256, n_blocks=2, n_block_layers=4,
+            n_global_embed=4, n_speakers=3, fused=fused)
+    model = ae.AutoEncoder({}, {'n_out': 32}, {'type': 'ae', 'n_out': 16},
+            dec_par, ds.num_mel_chan(), training=False)
+    model.post_init(ds)
+    return model
+
+
+def test_step_matches_forward():
+    torch.manual_seed(0)
+    model = make_model()
+    dec = model.decoder
+    n_batch, n_ts = 2, model.dec_in_len
+    lc_sparse = torch.randn(n_batch, 16, model.embed_len)
+    speaker_inds = torch.tensor([0, 2])
+    wav = torch.randint(0, 256, (n_batch, n_ts))
+    jitter_index = torch.arange(model.embed_len).repeat(n_batch, 1)
+
+    with torch.no_grad():
+        ref = dec(model.preprocess(wav), lc_sparse, speaker_inds, jitter_index)
+        lc, cond_bias = dec.incremental_cond(lc_sparse, speaker_inds)
+        queues = dec.init_queues(n_batch)
+        weights = dec.step_weights()
+        out = torch.stack([dec.step(wav[:,t], lc[:,:,t], cond_bias, queues, t,
+            weights) for t in range(n_ts)], dim=2)
+
+    # forward only produces outputs with a full receptive field
+    n_wing = n_ts - ref.shape[2]
+    assert (out[:,:,n_wing:] - ref).abs().max().item() < 1e-4
+
+
+def test_generate():
+    torch.manual_seed(0)
+    model = make_model()
+    lc_sparse = torch.randn(3, 16, 10)
+    out = model.decoder.generate(lc_sparse, torch.tensor([0, 1, 2]))
+    n_ts = model.decoder.incremental_cond(lc_sparse,
+            torch.tensor([0, 1, 2]))[0].shape[2]
+    assert out.shape == (3, n_ts)
+    assert out.min().item() >= 0 and out.max().item() < 256
+
+    greedy = model.decoder.generate(lc_sparse, torch.tensor([0, 1, 2]),
+            temperature=0)
+    assert torch.equal(greedy, model.decoder.generate(lc_sparse,
+        torch.tensor([0, 1, 2]), temperature=0))
+
+
+def test_sample_streams():
+    torch.manual_seed(0)
+    model = make_model()
+    dec = model.decoder
+    conds = [dec.incremental_cond(torch.randn(1, 16, n), torch.tensor([n % 3]))
+            for n in (10, 13, 11, 16, 10)]
+    out = dict(dec.sample_streams([(lc[0], bias[0]) for lc, bias in conds], 2,
+        temperature=0))
+    assert sorted(out.keys()) == list(range(len(conds)))
+    for i, (lc, bias) in enumerate(conds):
+        assert torch.equal(out[i], dec.sample(lc, bias, temperature=0)[0])
+
+
+def test_fused_matches_separate():
+    torch.manual_seed(0)
+    model = make_model()
+    fused = make_model(fused=True)
+    fused.load_state_dict(model.state_dict())
+    n_batch = 2
+    lc_sparse = torch.randn(n_batch, 16, model.embed_len, requires_grad=True)
+    speaker_inds = torch.tensor([1, 0])
+    wav = model.preprocess(torch.randint(0, 256, (n_batch, model.dec_in_len)))
+    jitter_index = torch.arange(model.embed_len).repeat(n_batch, 1)
+
+    outs = []
+    for m in (model, fused):
+        out = m.decoder(wav, lc_sparse, speaker_inds, jitter_index)
+        grad, = torch.autograd.grad(out.square().sum(), lc_sparse)
+        outs.append((out, grad))
+    assert (outs[0][0] - outs[1][0]).abs().max().item() < 1e-5
+    assert (outs[0][1] - outs[1][1]).abs().max().item() < 1e-4
+
+    # and back
+    separate = make_model()
+    separate.load_state_dict(fused.state_dict())
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, separate.state_dict()[k]), k
+
+
+def test_checkpoint_layers_gradients():
+    torch.manual_seed(0)
+    model = make_model()
+    model.decoder.train()
+    lc_sparse = torch.randn(2, 16, model.embed_len, requires_grad=True)
+    speaker_inds = torch.tensor([1, 0])
+    wav = model.preprocess(torch.randint(0, 256, (2, model.dec_in_len)))
+    jitter_index = torch.arange(model.embed_len).repeat(2, 1)
+
+    outs = []
+    for k in (0, 3):
+        model.decoder.checkpoint_layers = k
+        out = model.decoder(wav, lc_sparse, speaker_inds, jitter_index)
+        params = [p for p in model.decoder.parameters() if p.requires_grad]
+        grads = torch.autograd.grad(out.square().sum(), [lc_sparse] + params,
+                allow_unused=True)
+        outs.append((out, grads))
+    assert torch.allclose(outs[0][0], outs[1][0], atol=1e-6)
+    for g0, g1 in zip(outs[0][1], outs[1][1]):
+        assert (g0 is None and g1 is None) or torch.allclose(g0, g1,
+                rtol=1e-4, atol=1e-4)
+
+
+def test_old_checkpoint_conditioning():
+    # Checkpoints from before the embedding lookup have the one-hot 'eye'
+    model = make_model()
+    state = model.state_dict()
+    state['decoder.cond.eye'] = torch.eye(3)
+    model.load_state_dict(state)
+    cond = model.decoder.cond
+    inds = torch.tensor([2, 0, 1])
+    assert torch.allclose(cond(inds), cond.speaker_embedding(torch.eye(3)[inds]))
+
+
+if __name__ == '__main__':
+    test_step_matches_forward()
+    test_generate()
+    test_sample_streams()
+    test_fused_matches_separate()
+    test_checkpoint_layers_gradients()
+    test_old_checkpoint_conditioning()
+    print('Passed')
@@ -1,13 +1,30 @@
+import os
 import sys
 from sys import stderr
 from pprint import pprint
 import torch
+import torch.distributed as dist
 
 import model as ae
 import parse_tools  
 import netmisc
 
 
+def _cpu_fn(index, mode, opts):
+    """
+    One data-parallel training process.  Processes are ranked host by host
+    """
+    world_size = opts.n_nodes * opts.n_procs
+    rank = opts.node_rank * opts.n_procs + index
+    torch.set_num_threads(max(1, os.cpu_count() // opts.n_procs))
+    dist.init_process_group('gloo', init_method='tcp://{}:{}'.format(
+        opts.master_addr, opts.master_port), rank=rank, world_size=world_size)
+    try:
+        ae.Metrics(mode, opts).train(rank)
+    finally:
+        dist.destroy_process_group()
+
+
 def main():
     if len(sys.argv) == 1 or sys.argv[1] not in ('new', 'resume'):
         print(parse_tools.top_usage, file=stderr)
@@ -30,10 +47,13 @@ def main():
             raise RuntimeError('GPU requested but not available')
     elif opts.hwtype in ('TPU', 'TPU-single'):
         import torch_xla.distributed.xla_multiprocessing as xmp
+    elif opts.hwtype == 'CPU':
+        if not 0 <= opts.node_rank < opts.n_nodes:
+            raise RuntimeError('--node-rank must be in [0, --n-nodes)')
     else:
         raise RuntimeError(
                 ('Invalid device {} requested.  ' 
-                + 'Must be GPU or TPU').format(opts.hwtype))
+                + 'Must be CPU, GPU or TPU').format(opts.hwtype))
 
     print('Using {}'.format(opts.hwtype), file=stderr)
     stderr.flush()
@@ -47,6 +67,12 @@ def main():
 
     if opts.hwtype == 'GPU':
         ae.Metrics(mode, opts).train(0)
+    elif opts.hwtype == 'CPU':
+        if opts.n_nodes * opts.n_procs == 1:
+            ae.Metrics(mode, opts).train(0)
+        else:
+            torch.multiprocessing.spawn(_cpu_fn, args=(mode, opts),
+                    nprocs=opts.n_procs)
     elif opts.hwtype == 'TPU':
         def _mp_fn(index, mode, opts):
             m = ae.Metrics(mode, opts)
@@ -29,13 +29,17 @@ class VAE(nn.Module):
         # Input: (B, I, T)
         # Output: (B * L, C, T)
         # lin is the output of 'Linear(128)' from Figure 1 of Chorowski Jan 2019.
-        lin = self.linear(z)
+        # fp32 under autocast, for the KL terms of SGVBLoss
+        lin = self.linear(z).float()
 
         # Chorowski doesn't specify anything between lin and mu/sigma.  But, at
         # the very least, sigma must be positive.  So, I adopt techniques from
         # Appendix C.2, Gaussian MLP as encoder or decoder" from Kingma VAE
         # paper.
         mu, log_sigma_sq = torch.split(lin, self.n_out_chan, dim=1)
+        if not self.training:
+            # Use the posterior mean for inference
+            return mu
         sigma = torch.exp(0.5 * log_sigma_sq)
         # sigma_sq = mss[:,n_out_chan:,:]
         #sigma = torch.sqrt(sigma_sq)
@@ -62,6 +66,11 @@ class VAE(nn.Module):
         return samples
 
 class SGVBLoss(nn.Module):
+    # The KL term is summed over the batch, but free nats apply per batch.
+    # Accumulated micro-batches are averaged, keeping the loss at the scale
+    # of a single batch
+    reduction = 'mean'
+
     def __init__(self, bottleneck, free_nats):
         super(SGVBLoss, self).__init__()
         self.bottleneck = bottleneck
@@ -87,7 +96,9 @@ class SGVBLoss(nn.Module):
         # mu, log_sigma_sq: (B, T, K), the vectors output by the bottleneck
         # Output: scalar, L(theta, phi, x)
         # log_sigma_sq = self.bottleneck.log_sigma_sq
-        log_pred = self.logsoftmax(quant_pred)
+        # fp32 under autocast.  mu and sigma_sq already are, so the KL terms
+        # are too
+        log_pred = self.logsoftmax(quant_pred.float())
         sigma_sq = self.bottleneck.sigma_sq
         mu = self.bottleneck.mu
         log_sigma_sq = torch.log(sigma_sq)
@@ -0,0 +1,91 @@
+from sys import stderr
+import argparse
+import time
+import torch
+import util
+import vq_index
+
+# Compares exact and approximate (vq_index.IVFIndex) nearest code search in
+# the VQ bottlenecks: time per search, recall, and codebook usage entropy,
+# as reported by the 'hst_ent' training metric.  Vectors and codes are drawn
+# from the same Gaussian mixture, so that codes are clustered as after
+# training.
+
+def make_parser():
+    p = argparse.ArgumentParser()
+    p.add_argument('--n-codes', '-k', type=int, metavar='INT', default=32768,
+            help='codebook size')
+    p.add_argument('--n-dims', '-d', type=int, metavar='INT', default=64,
+            help='code dimension (--bn-n-out)')
+    p.add_argument('--n-vecs', '-nv', type=int, metavar='INT', default=4096,
+            help='vectors searched at once, n_batch * n_timesteps')
+    p.add_argument('--n-clusters', '-nc', type=int, metavar='INT',
+            default=256, help='mixture components of the synthetic data')
+    p.add_argument('--spread', '-s', type=float, metavar='FLOAT',
+            default=1.0, help='standard deviation of each mixture component, '
+            'relative to that of the component means.  Larger is harder')
+    p.add_argument('--lists', '-l', type=int, nargs='+', metavar='INT',
+            default=[64, 256], help='--bn-vq-index-lists values to try')
+    p.add_argument('--probes', '-p', type=int, nargs='+', metavar='INT',
+            default=[1, 4, 8, 16], help='--bn-vq-index-probes values to try')
+    p.add_argument('--unscaled', action='store_true', default=False,
+            help='squared L2 distance, as vq_bn.VQ, rather than the '
+            'scaled_l2_norm of vqema_bn.VQEMA')
+    p.add_argument('--n-reps', '-r', type=int, metavar='INT', default=5,
+            help='searches timed for each setting')
+    p.add_argument('--random-seed', '-rnd', type=int, metavar='INT',
+            default=2507)
+    return p
+
+
+def mixture(n, centers, spread):
+    comp = torch.randint(len(centers), (n,))
+    return centers[comp] + spread * torch.randn(n, centers.shape[1])
+
+
+def timed(fn, n_reps):
+    """Result of fn and its fastest time in ms over n_reps calls"""
+    best = float('inf')
+    for _ in range(n_reps):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return out, best * 1000
+
+
+def usage_entropy(inds, n_codes):
+    hist = torch.bincount(inds.flatten(), minlength=n_codes).float()
+    return util.entropy(hist, True).item()
+
+
+def main():
+    opts = make_parser().parse_args()
+    torch.manual_seed(opts.random_seed)
+    scaled = not opts.unscaled
+
+    centers = torch.randn(opts.n_clusters, opts.n_dims)
+    emb = mixture(opts.n_codes, centers, opts.spread)
+    z = mixture(opts.n_vecs, centers, opts.spread).t().unsqueeze(0) # (1, D, N)
+
+    exact, exact_ms = timed(lambda: vq_index.nearest_codes(z, emb, scaled),
+            opts.n_reps)
+    print('method\tlists\tprobes\tbuild_ms\tsearch_ms\trecall\thst_ent')
+    print('exact\t-\t-\t-\t{:.1f}\t1.000\t{:.3f}'.format(exact_ms,
+        usage_entropy(exact, opts.n_codes)))
+
+    for n_lists in opts.lists:
+        for n_probe in opts.probes:
+            if n_probe > n_lists:
+                continue
+            index = vq_index.IVFIndex(n_lists, n_probe, scaled)
+            _, build_ms = timed(lambda: index.build(emb), 1)
+            approx, search_ms = timed(lambda: index.search(z), opts.n_reps)
+            recall = (approx == exact).float().mean().item()
+            print('ivf\t{}\t{}\t{:.0f}\t{:.1f}\t{:.3f}\t{:.3f}'.format(n_lists,
+                n_probe, build_ms, search_ms, recall,
+                usage_entropy(approx, opts.n_codes)))
+            stderr.flush()
+
+
+if __name__ == '__main__':
+    main()
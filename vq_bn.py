@@ -2,6 +2,8 @@ import torch
 from torch import nn
 import netmisc
 import util
+from vqema_bn import StopGrad, ReplaceGrad
+from vq_index import nearest_codes
 
 
 class VQ(nn.Module):
@@ -19,26 +21,35 @@ class VQ(nn.Module):
         self.circ_inds = None
         self.emb = nn.Parameter(data=torch.empty(self.k, self.d))
         nn.init.xavier_uniform_(self.emb, gain=1)
+        # Set by AutoEncoder.init_codebook, so resuming doesn't repeat it
+        self.register_buffer('codebook_init', torch.tensor(False))
 
         netmisc.xavier_init(self.linear)
 
         # Shows how many of the embedding vectors have non-zero gradients
         #self.emb.register_hook(lambda k: print(k.sum(dim=1).unique(sorted=True)))
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints were always saved after codebook initialization
+        state_dict.setdefault(prefix + 'codebook_init', torch.tensor(True))
+        super(VQ, self)._load_from_state_dict(state_dict, prefix, *args,
+                **kwargs)
+
     def forward(self, z):
         """
         B, Q, K, N: n_batch, n_quant_dims, n_quant_vecs, n_timesteps
         ze: (B, Q, N) 
         emb: (K, Q)
         """
-        ze = self.linear(z)
+        ze = self.linear(z).float()
 
         self.ze = ze
         
         sg_emb = self.sg(self.emb)
-        l2norm_sq = ((ze.unsqueeze(1) - sg_emb.unsqueeze(2)) ** 2).sum(dim=2) # B, K, N
-        self.min_dist, min_ind = l2norm_sq.min(dim=1) # B, N
+        min_ind = nearest_codes(ze, sg_emb) # B, N
         zq = util.gather_md(sg_emb, 0, min_ind).permute(1, 0, 2)
+        # Exact, and differentiable in ze, for the selected codes only
+        self.min_dist = ((ze - zq) ** 2).sum(dim=1) # B, N
         zq_rg, __ = self.rg(zq, self.ze)
 
         # Diagnostics
@@ -61,6 +72,9 @@ class VQ(nn.Module):
         return zq_rg
 
 class VQLoss(nn.Module):
+    # Summed over the batch, so accumulated micro-batches are summed too
+    reduction = 'sum'
+
     def __init__(self, bottleneck):
         super(VQLoss, self).__init__()
         self.bn = bottleneck 
@@ -79,7 +93,7 @@ class VQLoss(nn.Module):
         # l2_loss_embeds = scaled_l2_norm(self.bn.sg(self.bn.ze), self.bn.emb)
         com_loss_embeds = self.bn.min_dist * self.bn.gamma
 
-        log_pred = self.logsoftmax(quant_pred)
+        log_pred = self.logsoftmax(quant_pred.float())
         log_pred_target = torch.gather(log_pred, 1,
                 target_wav.long().unsqueeze(1))
 
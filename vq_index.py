@@ -0,0 +1,127 @@
+import torch
+import kmeans
+
+
+def code_distances(zf, z_sq, emb, scaled=False):
+    """
+    Distances between vectors and codes, expanded as
+    ||z||^2 - 2 z.e + ||e||^2 so that they take a single matmul.  If scaled,
+    the distance is vqema_bn.scaled_l2_norm instead of squared L2.
+    M, C, D: n_vecs, n_codes, n_quant_dims
+    zf: (M, D)
+    z_sq: (M, 1) squared norms of zf
+    emb: (C, D)
+    returns: (M, C)
+    """
+    e_sq = (emb ** 2).sum(dim=1)
+    dist = torch.addmm(e_sq, zf, emb.t(), alpha=-2).add_(z_sq)
+    if scaled:
+        dist = dist.clamp_(min=0).sqrt_().div_(z_sq.sqrt() + e_sq.sqrt())
+    return dist
+
+
+def _flatten(z):
+    """(B, D, N) -> (B * N, D) fp32 vectors and their (B * N, 1) squared norms"""
+    zf = z.float().permute(0, 2, 1).reshape(-1, z.shape[1])
+    return zf, (zf ** 2).sum(dim=1, keepdim=True)
+
+
+def nearest_codes(z, emb, scaled=False, chunk_size=1024):
+    """
+    Index of the row of emb nearest to each vector of z, by squared L2
+    distance, or by scaled_l2_norm if scaled.  Distances are computed by
+    code_distances over chunk_size codes at a time, so memory is
+    O(B * N * chunk_size) rather than O(B * N * K * D).
+    Not differentiable; callers recompute the distance to the chosen codes.
+    B, D, K, N: n_batch, n_quant_dims, n_quant_vecs, n_timesteps
+    z: (B, D, N)
+    emb: (K, D)
+    returns: (B, N)
+    """
+    n_batch, _, n_ts = z.shape
+    with torch.no_grad(), torch.autocast(z.device.type, enabled=False):
+        zf, z_sq = _flatten(z)
+        best_dist, best_ind = None, None
+        for beg in range(0, emb.shape[0], chunk_size):
+            dist = code_distances(zf, z_sq, emb[beg:beg + chunk_size].float(),
+                    scaled)
+            chunk_dist, chunk_ind = dist.min(dim=1)
+            if best_ind is None:
+                best_dist, best_ind = chunk_dist, chunk_ind
+            else:
+                # Ties go to the earlier code, as with a single min
+                closer = chunk_dist < best_dist
+                best_dist = torch.where(closer, chunk_dist, best_dist)
+                best_ind = torch.where(closer, chunk_ind + beg, best_ind)
+    return best_ind.view(n_batch, n_ts)
+
+
+class IVFIndex(object):
+    """
+    Approximate nearest_codes for large codebooks.  The codes are partitioned
+    into n_lists clusters by k-means, and each vector is only compared with
+    the codes of the n_probe clusters with the nearest centroids, which is
+    about n_probe / n_lists of the exact search's work.  Recall drops with
+    that ratio; vq_bench.py measures it.  build must be called again
+    whenever the codebook changes.
+    """
+    def __init__(self, n_lists, n_probe, scaled=False):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.scaled = scaled
+        self.centroids = None
+
+    def build(self, emb):
+        """
+        Partition the codes, the rows of emb.  A fixed seed keeps this from
+        consuming the global random state used for training data.
+        """
+        generator = torch.Generator().manual_seed(0)
+        with torch.no_grad():
+            emb = emb.detach().float()
+            centroids, assign = kmeans.kmeans(emb, self.n_lists,
+                    generator=generator)
+            counts = torch.bincount(assign, minlength=len(centroids))
+            keep = counts > 0
+            # code indices grouped by list, and each list's extent
+            self.codes = assign.argsort()
+            self.code_vecs = emb[self.codes]
+            self.centroids = centroids[keep]
+            self.counts = counts[keep].tolist()
+            self.starts = (counts.cumsum(0) - counts)[keep].tolist()
+
+    def search(self, z):
+        """
+        Approximately nearest_codes(z, emb, self.scaled), for the emb of the
+        last build.  Vectors are grouped by probed list, so that each list's
+        codes are compared with all of its vectors in one matmul.
+        z: (B, D, N)
+        returns: (B, N)
+        """
+        n_batch, _, n_ts = z.shape
+        with torch.no_grad(), torch.autocast(z.device.type, enabled=False):
+            zf, z_sq = _flatten(z)
+            n_vecs = zf.shape[0]
+            n_probe = min(self.n_probe, len(self.centroids))
+            probes = code_distances(zf, z_sq, self.centroids).topk(n_probe,
+                    dim=1, largest=False)[1]
+            lists, order = probes.flatten().sort()
+            vecs = order // n_probe
+            per_list = torch.bincount(lists,
+                    minlength=len(self.centroids)).tolist()
+
+            best_dist = zf.new_full((n_vecs,), float('inf'))
+            best_ind = torch.zeros(n_vecs, dtype=torch.long, device=z.device)
+            for beg, n_codes, v in zip(self.starts, self.counts,
+                    vecs.split(per_list)):
+                if len(v) == 0:
+                    continue
+                dist = code_distances(zf[v], z_sq[v],
+                        self.code_vecs[beg:beg + n_codes], self.scaled)
+                list_dist, list_ind = dist.min(dim=1)
+                # A vector probes each list at most once, so v is unique
+                closer = list_dist < best_dist[v]
+                best_dist[v] = torch.where(closer, list_dist, best_dist[v])
+                best_ind[v] = torch.where(closer,
+                        self.codes[beg + list_ind], best_ind[v])
+        return best_ind.view(n_batch, n_ts)
@@ -1,7 +1,9 @@
 import torch
 from torch import nn
+import torch.distributed as dist
 import netmisc
 import util
+from vq_index import nearest_codes, IVFIndex
 
 
 class StopGradFn(torch.autograd.Function):
@@ -64,24 +66,25 @@ class ReplaceGrad(nn.Module):
         return ReplaceGradFn.apply(src, trg)
 
 
-def scaled_l2_norm(z, q):
+def scaled_l2_norm(z, q, dim=2):
     """
-    Computes a distance D(z, q) with properties:
+    Computes a distance D(z, q) along dim with properties:
     D(lambda * z, lambda * q) = D(z, q)
     D(z, 0) = D(0, z) = 1
     D(z, lambda*z) = |1-lambda| / (1 + |lambda|)
     """
-    num = ((z - q) ** 2).sum(dim=2).sqrt()
-    den = (z ** 2).sum(dim=2).sqrt() + (q ** 2).sum(dim=2).sqrt()
+    num = ((z - q) ** 2).sum(dim=dim).sqrt()
+    den = (z ** 2).sum(dim=dim).sqrt() + (q ** 2).sum(dim=dim).sqrt()
     return num / den
-    
+
 
 class VQEMA(nn.Module):
     """
     Vector Quantization bottleneck using Exponential Moving Average
     updates of the Codebook vectors.
     """
-    def __init__(self, n_in, n_out, vq_gamma, vq_ema_gamma, vq_n_embed, training):
+    def __init__(self, n_in, n_out, vq_gamma, vq_ema_gamma, vq_n_embed, training,
+            vq_index_lists=0, vq_index_probes=8):
         super(VQEMA, self).__init__()
         self.training = training
         self.d = n_out
@@ -93,21 +96,39 @@ class VQEMA(nn.Module):
         self.sg = StopGrad()
         self.rg = ReplaceGrad()
         self.ze = None
+        self.min_ind = None
         self.register_buffer('emb', torch.empty(self.k, self.d))
         nn.init.xavier_uniform_(self.emb, gain=10)
+        # Set by AutoEncoder.init_codebook, so resuming doesn't repeat it
+        self.register_buffer('codebook_init', torch.tensor(False))
+
+        # Approximate code search, for large codebooks
+        self.index = None
+        if vq_index_lists > 0:
+            self.index = IVFIndex(vq_index_lists, vq_index_probes, scaled=True)
 
         if self.ema_gamma >= 1.0 or self.ema_gamma <= 0:
             raise RuntimeError('VQEMA must use an EMA-gamma value in (0, 1)')
 
         if self.training:
             self.min_dist = None
-            self.circ_inds = None
             self.register_buffer('ind_hist', torch.zeros(self.k))
             self.register_buffer('ema_numer', torch.empty(self.k, self.d))
             self.register_buffer('ema_denom', torch.empty(self.k))
-            self.register_buffer('z_sum', torch.empty(self.k, self.d))
-            self.register_buffer('n_sum', torch.empty(self.k))
+            # Statistics of the current optimizer step, over all its
+            # micro-batches.  update_ema folds them into the averages
+            self.register_buffer('z_sum', torch.zeros(self.k, self.d))
+            self.register_buffer('n_sum', torch.zeros(self.k))
             self.register_buffer('n_sum_ones', torch.ones(self.k))
+            # Assignments per step to each code, averaged with ema_gamma.
+            # Used by reseed_dead_codes
+            self.register_buffer('usage', torch.zeros(self.k))
+            # The most recent encoder outputs, candidates for reseeding
+            self.register_buffer('recent_ze', torch.zeros(self.k, self.d),
+                    persistent=False)
+            self.n_recent = 0
+            self.recent_pos = 0
+            self.reseed_gen = None
             #self.ema_numer.detach_()
             #self.ema_denom.detach_()
             #self.z_sum.detach_()
@@ -122,40 +143,47 @@ class VQEMA(nn.Module):
         # Shows how many of the embedding vectors have non-zero gradients
         #self.emb.register_hook(lambda k: print(k.sum(dim=1).unique(sorted=True)))
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints were always saved after codebook initialization
+        state_dict.setdefault(prefix + 'codebook_init', torch.tensor(True))
+        if self.training and prefix + 'usage' not in state_dict:
+            state_dict[prefix + 'usage'] = state_dict[prefix + 'n_sum'].clone()
+        if self.training:
+            # Older checkpoints hold the sums of their last step, already used
+            for name in ('z_sum', 'n_sum'):
+                if prefix + name in state_dict:
+                    state_dict[prefix + name] = torch.zeros_like(
+                            state_dict[prefix + name])
+        super(VQEMA, self)._load_from_state_dict(state_dict, prefix, *args,
+                **kwargs)
+
     def forward(self, z):
         """
         B, Q, K, N: n_batch, n_quant_dims, n_quant_vecs, n_timesteps
         ze: (B, Q, N) 
         emb: (K, Q)
         """
-        ze = self.linear(z)
+        # Distances and EMA statistics are computed in fp32 under autocast
+        ze = self.linear(z).float()
         self.ze = ze
         sg_emb = self.sg(self.emb)
 
-        l2norm_sq = ((ze.unsqueeze(1) - sg_emb.unsqueeze(2)) ** 2).sum(dim=2) # B, K, N
-        # self.min_dist, min_ind = l2norm_sq.min(dim=1) # B, N
-
-        snorm = scaled_l2_norm(ze.unsqueeze(1),
-                sg_emb.unsqueeze(2).unsqueeze(0))
-        #print('snorm: ', snorm)
-        self.min_dist, min_ind = snorm.min(dim=1) # B, N
+        if self.index is None:
+            min_ind = nearest_codes(ze, sg_emb, scaled=True) # B, N
+        else:
+            if self.index.centroids is None:
+                self.refresh_index()
+            min_ind = self.index.search(ze)
         zq = util.gather_md(sg_emb, 0, min_ind).permute(1, 0, 2)
+        # Exact, and differentiable in ze, for the selected codes only
+        self.min_dist = scaled_l2_norm(ze, zq, dim=1) # B, N
 
         if self.training:
-            # Diagnostics
-            ni = min_ind.nelement() 
-            #if self.circ_inds is None:
-            #    self.write_pos = 0
-            #    self.circ_inds = ze.new_full((100, ni), -1, dtype=torch.long)
-
-            #self.circ_inds[self.write_pos,0:ni] = min_ind.flatten(0)
-            #self.circ_inds[self.write_pos,ni:] = -1
-            #self.write_pos += 1
-            #self.write_pos = self.write_pos % 100
-            ones = self.emb.new_ones(ni)
-            util.int_hist(min_ind, accu=self.ind_hist)
-            self.uniq = min_ind.unique(sorted=False)
-            self.ze_norm = (self.ze ** 2).sum(dim=1).sqrt()
+            # Diagnostics, read by VQEMALoss and diagnostics.VQDiagnostics.
+            # None of these wait for the device
+            self.ind_hist.index_add_(0, min_ind.flatten(),
+                    self.ind_hist.new_ones(min_ind.nelement()))
+            self.ze_norm = (self.ze.detach() ** 2).sum(dim=1).sqrt()
             self.emb_norm = (self.emb ** 2).sum(dim=1).sqrt()
             self.min_ind = min_ind
 
@@ -176,42 +204,50 @@ class VQEMA(nn.Module):
             n_sum_tmp = self.n_sum.new_zeros(idim)
 
             z_sum_tmp = self.z_sum.new_zeros(z_tmp_shape)
+            # detached, so the statistics don't chain graphs across steps
             z_sum_tmp.scatter_add_(0,
                     flat_ind.unsqueeze(1).repeat(1, self.d),
-                    self.ze.permute(0,2,1).flatten(0, 1)
+                    self.ze.detach().permute(0,2,1).flatten(0, 1)
                     )
-            self.z_sum[...] = z_sum_tmp[0:self.k,:]
+            self.z_sum += z_sum_tmp[0:self.k,:]
 
-            self.n_sum.zero_()
             n_sum_ones = n_sum_tmp.new_ones((idim))
             n_sum_tmp.scatter_add_(0, flat_ind, n_sum_ones)
-            self.n_sum[...] = n_sum_tmp[0:self.k]
-
-            self.ema_numer = (
-                    self.ema_gamma * self.ema_numer +
-                    self.ema_gamma_comp * self.z_sum) 
-            self.ema_denom = (
-                    self.ema_gamma * self.ema_denom +
-                    self.ema_gamma_comp * self.n_sum)
+            self.n_sum += n_sum_tmp[0:self.k]
+            self.save_recent(self.ze.detach())
 
             # construct the straight-through estimator ('ReplaceGrad')
             # What I need is 
             # cb_update = self.ema_numer / self.ema_denom.unsqueeze(1).repeat(1,
             #         self.d)
 
-            # print('z_sum_norm:', (self.z_sum ** 2).sum(dim=1).sqrt())
-            # print('n_sum_norm:', self.n_sum)
-            print('ze_norm:', self.ze_norm)
-            print('emb_norm:', (self.emb ** 2).sum(dim=1).sqrt())
-            print('min_ind:', self.min_ind)
-            # print('cb_update_norm:', (cb_update ** 2).sum(dim=1).sqrt())
-            # print('ema_numer_norm:',
-            #         (self.ema_numer ** 2).sum(dim=1).sqrt().mean())
-            # print('ema_denom_norm:',
-            #         (self.ema_denom ** 2).sqrt().mean())
             zq_rg, __ = self.rg(zq, self.ze)
+            return zq_rg
+
+        return zq
 
-        return zq_rg
+    def update_ema(self):
+        """
+        Fold the statistics accumulated by forward since the last call into
+        the EMA averages.  Called once per optimizer step, however many
+        micro-batches it has
+        """
+        # With data-parallel training, every process updates its
+        # codebook from the statistics of the whole batch
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.z_sum)
+            dist.all_reduce(self.n_sum)
+
+        self.ema_numer = (
+                self.ema_gamma * self.ema_numer +
+                self.ema_gamma_comp * self.z_sum) 
+        self.ema_denom = (
+                self.ema_gamma * self.ema_denom +
+                self.ema_gamma_comp * self.n_sum)
+        self.usage.mul_(self.ema_gamma).add_(self.n_sum,
+                alpha=self.ema_gamma_comp)
+        self.z_sum.zero_()
+        self.n_sum.zero_()
 
     def update_codebook(self):
         """
@@ -220,9 +256,81 @@ class VQEMA(nn.Module):
         self.emb = self.ema_numer / self.ema_denom.unsqueeze(1).repeat(1,
                 self.d)
         self.emb.detach_()
+        self.refresh_index()
+
+    def save_recent(self, ze):
+        """
+        Keep a random subset of ze (B, D, N) in the recent_ze ring buffer
+        """
+        flat = ze.permute(0, 2, 1).flatten(0, 1)
+        n = min(flat.shape[0], self.k)
+        sub = torch.randperm(flat.shape[0], generator=self.generator(),
+                device=flat.device)[:n]
+        pos = torch.arange(self.recent_pos, self.recent_pos + n,
+                device=flat.device) % self.k
+        self.recent_ze[pos] = flat[sub]
+        self.recent_pos = (self.recent_pos + n) % self.k
+        self.n_recent = min(self.n_recent + n, self.k)
+
+    def generator(self):
+        """
+        Private random stream for reseeding, so the data stream is unchanged
+        """
+        if self.reseed_gen is None:
+            self.reseed_gen = torch.Generator(device=self.emb.device)
+            self.reseed_gen.manual_seed(0)
+        return self.reseed_gen
+
+    def dead_codes(self, threshold):
+        """
+        Mask (K) of codes used less than threshold times the mean usage
+        """
+        return self.usage < threshold * self.usage.mean()
+
+    def reseed_dead_codes(self, threshold):
+        """
+        Replace each dead code with a distinct recent encoder output, and
+        restart its EMA statistics from there.  Returns the number of codes
+        replaced, as a tensor
+        """
+        if self.n_recent == 0:
+            return self.usage.new_zeros((), dtype=torch.long)
+
+        dead = self.dead_codes(threshold)
+        # Candidates are drawn without replacement while there are enough
+        perm = torch.randperm(self.n_recent, generator=self.generator(),
+                device=self.emb.device)
+        cand = self.recent_ze[perm.repeat(self.k // self.n_recent + 1)[:self.k]]
+        dead_col = dead.unsqueeze(1)
+        self.emb = torch.where(dead_col, cand, self.emb)
+        self.ema_numer = torch.where(dead_col, cand * self.ema_gamma_comp,
+                self.ema_numer)
+        self.ema_denom = torch.where(dead, self.n_sum_ones *
+                self.ema_gamma_comp, self.ema_denom)
+        # A grace period before a reseeded code can be judged dead again
+        self.usage = torch.where(dead, self.usage.mean(), self.usage)
+
+        # Processes hold different recent outputs, so take those of rank 0
+        if dist.is_available() and dist.is_initialized():
+            for buf in (self.emb, self.ema_numer, self.ema_denom):
+                dist.broadcast(buf, 0)
+        self.refresh_index()
+        return dead.sum()
+
+    def refresh_index(self):
+        """
+        Rebuild the approximate search index, if any, after emb changes
+        """
+        if self.index is not None:
+            self.index.build(self.emb)
 
 
 class VQEMALoss(nn.Module):
+    # Summed over the batch, so accumulated micro-batches are summed too
+    reduction = 'sum'
+    # Usage fraction reported as 'dead', set from --vq-reseed-threshold
+    dead_threshold = 0.01
+
     def __init__(self, bottleneck):
         super(VQEMALoss, self).__init__()
         self.bn = bottleneck 
@@ -236,7 +344,7 @@ class VQEMALoss(nn.Module):
         # Loss per embedding vector 
         com_loss_embeds = self.bn.min_dist * self.bn.gamma
 
-        log_pred = self.logsoftmax(quant_pred)
+        log_pred = self.logsoftmax(quant_pred.float())
         log_pred_target = torch.gather(log_pred, 1,
                 target_wav.long().unsqueeze(1))
 
@@ -256,10 +364,12 @@ class VQEMALoss(nn.Module):
                 'min_emb': self.bn.emb_norm.min(),
                 'max_emb': self.bn.emb_norm.max(),
                 'hst_ent': util.entropy(self.bn.ind_hist, True),
-                # 'hst_100': util.entropy(util.int_hist(self.bn.circ_inds, -1), True),
-                'nunq': self.bn.uniq.nelement(),
+                'nunq': (self.bn.n_sum > 0).sum(),
+                'dead': self.bn.dead_codes(self.dead_threshold).sum(),
                 'pk_m': log_pred.max(dim=1)[0].to(torch.float).mean(),
-                'pk_nuq': log_pred.max(dim=1)[1].unique().nelement(),
+                'pk_nuq': log_pred.new_zeros(log_pred.shape[1],
+                    dtype=torch.long).index_fill_(0,
+                    log_pred.max(dim=1)[1].flatten(), 1).sum(),
                 'pk_sd': log_pred.max(dim=1)[0].to(torch.float).std()
                 }
 
@@ -40,7 +40,8 @@ class ConvReLURes(nn.Module):
         # out = self.bn(out)
         act = self.relu(pre)
         if self.do_res:
-            act[...] += x[:,:,self.residual_offsets[0]:self.residual_offsets[1] or None]
+            # Not in place: backward of the ReLU needs its output
+            act = act + x[:,:,self.residual_offsets[0]:self.residual_offsets[1] or None]
             # act += x[:,:,self.residual_offsets[0]:self.residual_offsets[1] or None]
         #act_sum = act.sum()
         self.frac_zero_act = (act == 0.0).sum().double() / act.nelement()
@@ -1,30 +1,71 @@
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch import distributions as dist
 import vconv
 import numpy as np
 from numpy import prod as np_prod
-import util
 import netmisc
 
+class GatedActivationFn(torch.autograd.Function):
+    """
+    tanh(filt) * sigmoid(gate) for filt_gate = cat(filt, gate) on dim 1.
+    Only the input is saved for backward, which recomputes the activations,
+    instead of the four intermediates saved by the separate operations.
+    """
+    @staticmethod
+    def forward(ctx, filt_gate):
+        ctx.save_for_backward(filt_gate)
+        filt, gate = filt_gate.chunk(2, dim=1)
+        return torch.tanh(filt).mul_(torch.sigmoid(gate))
+
+    @staticmethod
+    def backward(ctx, z_grad):
+        filt_gate, = ctx.saved_tensors
+        filt, gate = filt_gate.chunk(2, dim=1)
+        t = torch.tanh(filt)
+        s = torch.sigmoid(gate)
+        filt_grad = z_grad * s * (1 - t * t)
+        gate_grad = z_grad * t * s * (1 - s)
+        return torch.cat((filt_grad, gate_grad), dim=1)
+
+
 class GatedResidualCondConv(nn.Module):
+    # Fused modules and the pairs of separate modules they stack
+    fused_modules = {
+            'conv': ('conv_signal', 'conv_gate'),
+            'proj': ('proj_signal', 'proj_gate'),
+            'dil_out': ('dil_res', 'dil_skp')
+            }
+
     def __init__(self, wavenet_vc, n_cond, n_res, n_dil, n_skp, stride, dil,
-            filter_sz=2, bias=True, parent_vc=None, name=None):
+            filter_sz=2, bias=True, parent_vc=None, name=None, fused=False):
         """
         filter_sz: # elements in the dilated kernels
         n_cond: # channels of local condition vectors
         n_res : # residual channels
         n_dil : # output channels for dilated kernel
         n_skp : # channels output to skip connections
+        fused: if True, signal and gate weights are stacked into one dilated
+        conv and one conditioning projection, and dil_res and dil_skp into one
+        1x1 conv.  The state dict of either version can be loaded into the
+        other.
         """
         super(GatedResidualCondConv, self).__init__()
         self.wavenet_vc = wavenet_vc 
-        self.conv_signal = nn.Conv1d(n_res, n_dil, filter_sz, dilation=dil, bias=bias)
-        self.conv_gate = nn.Conv1d(n_res, n_dil, filter_sz, dilation=dil, bias=bias)
-        self.proj_signal = nn.Conv1d(n_cond, n_dil, kernel_size=1, bias=False)
-        self.proj_gate = nn.Conv1d(n_cond, n_dil, kernel_size=1, bias=False)
-        self.dil_res = nn.Conv1d(n_dil, n_res, kernel_size=1, bias=False)
-        self.dil_skp = nn.Conv1d(n_dil, n_skp, kernel_size=1, bias=False)
+        self.fused = fused
+        self.n_res = n_res
+        if self.fused:
+            self.conv = nn.Conv1d(n_res, n_dil * 2, filter_sz, dilation=dil, bias=bias)
+            self.proj = nn.Conv1d(n_cond, n_dil * 2, kernel_size=1, bias=False)
+            self.dil_out = nn.Conv1d(n_dil, n_res + n_skp, kernel_size=1, bias=False)
+        else:
+            self.conv_signal = nn.Conv1d(n_res, n_dil, filter_sz, dilation=dil, bias=bias)
+            self.conv_gate = nn.Conv1d(n_res, n_dil, filter_sz, dilation=dil, bias=bias)
+            self.proj_signal = nn.Conv1d(n_cond, n_dil, kernel_size=1, bias=False)
+            self.proj_gate = nn.Conv1d(n_cond, n_dil, kernel_size=1, bias=False)
+            self.dil_res = nn.Conv1d(n_dil, n_res, kernel_size=1, bias=False)
+            self.dil_skp = nn.Conv1d(n_dil, n_skp, kernel_size=1, bias=False)
 
         # The dilated autoregressive convolution produces an output at the
         # right-most position of the receptive field.  (At the very end of a
@@ -34,6 +75,32 @@ class GatedResidualCondConv(nn.Module):
         self.vc = vconv.VirtualConv(filter_info=(dil_filter_sz - 1, 0),
                 parent=parent_vc, name=name)
         self.apply(netmisc.xavier_init)
+        if self.fused:
+            # Initialize each stacked part as its separate module would be
+            with torch.no_grad():
+                for mod, sizes in ((self.conv, [n_dil, n_dil]),
+                        (self.proj, [n_dil, n_dil]),
+                        (self.dil_out, [n_res, n_skp])):
+                    for w in mod.weight.split(sizes):
+                        nn.init.xavier_uniform_(w)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+        Convert the state dict of the other version (fused or not) to this one
+        """
+        for fused, (first, second) in self.fused_modules.items():
+            for p in ('weight', 'bias'):
+                fkey = prefix + fused + '.' + p
+                keys = (prefix + first + '.' + p, prefix + second + '.' + p)
+                if self.fused and keys[0] in state_dict:
+                    state_dict[fkey] = torch.cat((state_dict.pop(keys[0]),
+                        state_dict.pop(keys[1])))
+                elif not self.fused and fkey in state_dict:
+                    sizes = [getattr(self, m).out_channels for m in (first, second)]
+                    for key, val in zip(keys, state_dict.pop(fkey).split(sizes)):
+                        state_dict[key] = val
+        super(GatedResidualCondConv, self)._load_from_state_dict(state_dict,
+                prefix, *args, **kwargs)
 
     def post_init(self):
         """
@@ -54,49 +121,132 @@ class GatedResidualCondConv(nn.Module):
         self.register_buffer('skip_lead', torch.tensor(skip_lead))
         self.register_buffer('left_wing_size', torch.tensor(self.vc.l_wing_sz))
 
-    def forward(self, x, cond):
+    def proj_weight(self):
+        """
+        (2D, C) weight projecting conditioning vectors onto the signal and
+        gate channels.  See WaveNet.cond_proj_weight
+        """
+        if self.fused:
+            return self.proj.weight[:,:,0]
+        return torch.cat((self.proj_signal.weight, self.proj_gate.weight))[:,:,0]
+
+    def forward(self, x, cond_proj):
         """
         B, T: batchsize, win_size (determined from input)
-        C, R, D, S: n_cond, n_res, n_dil, n_skp
+        R, D, S: n_res, n_dil, n_skp
         x: (B, R, T) (necessary shape for Conv1d)
-        cond: (B, C, T) (necessary shape for Conv1d)
+        cond_proj: (B, 2D, T) conditioning projected by proj_weight() 
         returns: sig: (B, R, T), skp: (B, S, T) 
         """
-        filt = self.conv_signal(x) + self.proj_signal(cond[:,:,self.cond_lead:])
-        gate = self.conv_gate(x) + self.proj_gate(cond[:,:,self.cond_lead:])
+        if self.fused:
+            return self.forward_fused(x, cond_proj)
+        proj_signal, proj_gate = cond_proj[:,:,self.cond_lead:].chunk(2, dim=1)
+        filt = self.conv_signal(x) + proj_signal
+        gate = self.conv_gate(x) + proj_gate
         z = torch.tanh(filt) * torch.sigmoid(gate)
         sig = self.dil_res(z)
         skp = self.dil_skp(z[:,:,self.skip_lead:])
         sig += x[:,:,self.left_wing_size:]
         return sig, skp 
 
+    def forward_fused(self, x, cond_proj):
+        """
+        forward with the fused modules.  The skip outputs are computed over
+        the whole window along with the residual ones, then trimmed
+        """
+        filt_gate = self.conv(x)
+        filt_gate += cond_proj[:,:,self.cond_lead:]
+        z = GatedActivationFn.apply(filt_gate)
+        out = self.dil_out(z)
+        sig = out[:,:self.n_res] + x[:,:,self.left_wing_size:]
+        skp = out[:,self.n_res:,self.skip_lead:]
+        return sig, skp
+
+    def dilated_conv(self):
+        return self.conv if self.fused else self.conv_signal
+
+    def queue_len(self):
+        """Number of past inputs needed by the dilated kernels"""
+        conv = self.dilated_conv()
+        return (conv.kernel_size[0] - 1) * conv.dilation[0]
+
+    def step_weights(self):
+        """
+        Weights of forward rearranged for step, computed once per generation.
+        The dilated kernels of signal and gate are stacked and flattened to
+        act on the (B, R*K) concatenation of the K taps.
+        """
+        if self.fused:
+            res_w, skp_w = self.dil_out.weight[:,:,0].split(
+                    [self.n_res, self.dil_out.out_channels - self.n_res])
+            return self.conv.weight.flatten(1), self.conv.bias, res_w, skp_w
+
+        conv_w = torch.cat((self.conv_signal.weight, self.conv_gate.weight))
+        conv_b = None
+        if self.conv_signal.bias is not None:
+            conv_b = torch.cat((self.conv_signal.bias, self.conv_gate.bias))
+        return (conv_w.flatten(1), conv_b, self.dil_res.weight[:,:,0],
+                self.dil_skp.weight[:,:,0])
+
+    def step(self, x, cond_proj, queue, t, weights):
+        """
+        Compute one timestep of forward, for incremental generation.
+        B, R, D, S: n_batch, n_res, n_dil, n_skp
+        x: (B, R) input at time t
+        cond_proj: (B, 2D) projected conditioning at time t
+        queue: (B, R, N) inputs of times t-N to t-1, at position (time % N).
+        Updated in place with x.
+        weights: output of step_weights()
+        returns: sig: (B, R), skp: (B, S) outputs at time t
+        """
+        conv_w, conv_b, res_w, skp_w = weights
+        n = queue.shape[2]
+        k = self.dilated_conv().kernel_size[0]
+        dil = self.dilated_conv().dilation[0]
+        taps = [queue[:,:,(t - (k - 1 - i) * dil) % n] for i in range(k - 1)]
+        taps = torch.stack(taps + [x], dim=2)
+        queue[:,:,t % n] = x
+
+        filt_gate = nn.functional.linear(taps.flatten(1), conv_w, conv_b)
+        filt_gate += cond_proj
+        filt, gate = filt_gate.chunk(2, dim=1)
+        z = torch.tanh(filt) * torch.sigmoid(gate)
+        sig = nn.functional.linear(z, res_w) + x
+        skp = nn.functional.linear(z, skp_w)
+        return sig, skp
+
 
 class Conditioning(nn.Module):
     """
-    Module for merging up-sampled local conditioning vectors
-    with voice ids.
+    Module computing the speaker (global) conditioning vectors from voice
+    ids.  WaveNet projects them into a per-layer bias instead of merging
+    them with the local conditioning vectors at every timestep.
     """
     def __init__(self, n_speakers, n_embed, bias=True):
         super(Conditioning, self).__init__()
-        # Look at nn.embedding
+        # Applied to one-hot vectors, and kept as nn.Linear for checkpoints
         self.speaker_embedding = nn.Linear(n_speakers, n_embed, bias)
-        self.register_buffer('eye', torch.eye(n_speakers))
         self.apply(netmisc.xavier_init)
 
-    def forward(self, lc, speaker_inds):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints have the identity matrix used for one-hot vectors
+        state_dict.pop(prefix + 'eye', None)
+        super(Conditioning, self)._load_from_state_dict(state_dict, prefix,
+                *args, **kwargs)
+
+    def forward(self, speaker_inds):
         """
-        I, G, S: n_in_chan, n_embed_chan, n_speakers
-        lc : (B, T, I)
+        G, S: n_embed_chan, n_speakers
         speaker_inds: (B)
-        returns: (B, T, I+G)
+        returns: (B, G), speaker_embedding of the one-hot (B, S) vectors,
+        computed as a lookup
         """
         assert speaker_inds.dtype == torch.long
-        # one_hot: (B, S)
-        one_hot = util.gather_md(self.eye, 0, speaker_inds).permute(1, 0) 
-        gc = self.speaker_embedding(one_hot) # gc: (B, G)
-        gc_rep = gc.unsqueeze(2).expand(-1, -1, lc.shape[2])
-        all_cond = torch.cat((lc, gc_rep), dim=1) 
-        return all_cond
+        gc = nn.functional.embedding(speaker_inds,
+                self.speaker_embedding.weight.t())
+        if self.speaker_embedding.bias is not None:
+            gc = gc + self.speaker_embedding.bias
+        return gc
 
 class Upsampling(nn.Module):
     def __init__(self, n_chan, filter_sz, stride, parent_vc, bias=True, name=None):
@@ -137,13 +287,16 @@ class WaveNet(nn.Module):
     def __init__(self, filter_sz, n_lc_in, n_lc_out, lc_upsample_filt_sizes,
             lc_upsample_strides, n_res, n_dil, n_skp, n_post, n_quant,
             n_blocks, n_block_layers, n_speakers, n_global_embed,
-            bias=True, parent_vc=None):
+            bias=True, parent_vc=None, fused=False, checkpoint_layers=0):
         super(WaveNet, self).__init__()
 
         self.n_blocks = n_blocks
+        # In training, recompute the activations of each run of this many
+        # layers in the backward pass instead of keeping them.  0 keeps all
+        self.checkpoint_layers = checkpoint_layers
         self.n_block_layers = n_block_layers
         self.n_quant = n_quant
-        self.quant_onehot = None 
+        self.n_lc_out = n_lc_out
         self.bias = bias
         post_jitter_filt_sz = 3
         lc_input_stepsize = np_prod(lc_upsample_strides) 
@@ -187,7 +340,7 @@ class WaveNet(nn.Module):
                 dil = 2**bl
                 name = 'GRCC_{},{}(dil={})'.format(b, bl, dil)
                 grc = GatedResidualCondConv(self.vc, n_cond, n_res, n_dil,
-                        n_skp, 1, dil, filter_sz, bias, cur_vc, name)
+                        n_skp, 1, dil, filter_sz, bias, cur_vc, name, fused)
                 self.conv_layers.append(grc)
                 cur_vc = grc.vc
 
@@ -208,7 +361,20 @@ class WaveNet(nn.Module):
             grc.post_init()
 
 
-    def forward(self, wav_onehot, lc_sparse, speaker_inds, jitter_index):
+    def embed_input(self, wav_quant):
+        """
+        base_layer applied to the one-hot encoding of wav_quant, computed as
+        a lookup of base_layer's weight columns
+        wav_quant: (B, T) long
+        returns: (B, R, T)
+        """
+        emb = nn.functional.embedding(wav_quant,
+                self.base_layer.weight[:,:,0].t())
+        if self.base_layer.bias is not None:
+            emb = emb + self.base_layer.bias
+        return emb.permute(0, 2, 1)
+
+    def forward(self, wav_quant, lc_sparse, speaker_inds, jitter_index):
         """
         B: n_batch (# of separate wav streams being processed)
         T1: n_wav_timesteps
@@ -217,13 +383,14 @@ class WaveNet(nn.Module):
         L: n_lc_in
         Q: n_quant
 
-        wav: (B, Q, T1)
+        wav_quant: (B, T1) mu-law codes
         lc: (B, L, T2)
         speaker_inds: (B, T)
+        jitter_index: (B, T2) index into the timesteps of each lc
         outputs: (B, Q, N)
         """
         D1 = lc_sparse.size()[1]
-        lc_jitter = torch.take(lc_sparse,
+        lc_jitter = torch.gather(lc_sparse, 2,
                 jitter_index.unsqueeze(1).expand(-1, D1, -1))
         lc_conv = self.lc_conv(lc_jitter) 
         lc_dense = self.lc_upsample(lc_conv)
@@ -236,21 +403,284 @@ class WaveNet(nn.Module):
         # lc_dense_trim = torch.take(lc_dense,
         #         lcond_slice.unsqueeze(1).expand(-1, D2, -1))
 
-        cond = self.cond(lc_dense_trim, speaker_inds)
         # "The conditioning signal was passed separately into each layer" - p 5 pp 1.
         # Oddly, they claim the global signal is just passed in as one-hot vectors.
         # But, this means wavenet's parameters would have N_s baked in, and wouldn't
         # be able to operate with a new speaker ID.
 
-        sig = self.base_layer(wav_onehot) 
-        sig, skp_sum = self.conv_layers[0](sig, cond)
-        for layer in self.conv_layers[1:]:
-            sig, skp = layer(sig, cond)
-            skp_sum += skp
-            
+        # The speaker part is constant in time, so it is projected once, as
+        # a bias
+        lc_w, gc_w = self.cond_proj_weights()
+        cond_bias = self.global_cond_bias(speaker_inds, gc_w)
+
+        sig = self.embed_input(wav_quant)
+        skp_sum = None
+        n_layers = len(self.conv_layers)
+        seg_len = n_layers
+        if self.checkpoint_layers > 0 and self.training and \
+                torch.is_grad_enabled():
+            seg_len = self.checkpoint_layers
+        for beg in range(0, n_layers, seg_len):
+            args = (sig, skp_sum, lc_dense_trim, lc_w, cond_bias, beg,
+                    min(beg + seg_len, n_layers))
+            if seg_len < n_layers:
+                sig, skp_sum = torch.utils.checkpoint.checkpoint(
+                        self.run_layers, *args, use_reentrant=False)
+            else:
+                sig, skp_sum = self.run_layers(*args)
+
         post1 = self.post1(self.relu(skp_sum))
         quant = self.post2(self.relu(post1))
         # we only need this for inference time
         # logits = self.logsoftmax(quant) 
         return quant
 
+
+    def run_layers(self, sig, skp_sum, lc, lc_w, cond_bias, beg, end):
+        """
+        Runs layers beg to end - 1 on sig, adding their skip outputs to
+        skp_sum (None before the first layer).  Their conditioning is
+        projected from lc here, in one matmul, so that checkpointed runs
+        don't keep it either.
+        lc, lc_w, cond_bias: as in forward and step
+        """
+        rows = lc_w.shape[0] // len(self.conv_layers)
+        cond_proj = nn.functional.conv1d(lc,
+                lc_w[beg * rows:end * rows].unsqueeze(2))
+        cond_proj += cond_bias[:,beg * rows:end * rows].unsqueeze(2)
+        cond_projs = cond_proj.chunk(end - beg, dim=1)
+
+        for layer, layer_cond_proj in zip(self.conv_layers[beg:end],
+                cond_projs):
+            sig, skp = layer(sig, layer_cond_proj)
+            if skp_sum is None:
+                skp_sum = skp
+            elif layer is self.conv_layers[beg]:
+                # skp_sum is an input, which a checkpointed run must not
+                # modify
+                skp_sum = skp_sum + skp
+            else:
+                skp_sum += skp
+        return sig, skp_sum
+
+    def cond_proj_weights(self):
+        """
+        Stacked projections of all L layers, so that the conditioning is
+        projected for all of them at once.  Returns the (L * 2D, n_lc_out)
+        and (L * 2D, n_global_embed) parts acting on the local and speaker
+        conditioning vectors.
+        """
+        w = torch.cat([layer.proj_weight() for layer in self.conv_layers])
+        return w.split([self.n_lc_out, w.shape[1] - self.n_lc_out], dim=1)
+
+    def global_cond_bias(self, speaker_inds, gc_w=None):
+        """
+        (B, L * 2D) projection of the speaker conditioning for all layers
+        """
+        if gc_w is None:
+            gc_w = self.cond_proj_weights()[1]
+        return nn.functional.linear(self.cond(speaker_inds), gc_w)
+
+    def incremental_cond(self, lc_sparse, speaker_inds):
+        """
+        Full conditioning sequence for generation, without jitter.
+        L, C, P: n_lc_in, n_lc_out, L * 2D (see cond_proj_weights)
+        lc_sparse: (B, L, T2) encoded conditioning vectors
+        speaker_inds: (B)
+        returns: lc: (B, C, T), where position t conditions the input at wav
+        timestep t, as in forward, and cond_bias: (B, P) from global_cond_bias
+        """
+        lc_dense = self.lc_upsample(self.lc_conv(lc_sparse))
+        return (lc_dense[:,:,self.trim_ups_out[0]:],
+                self.global_cond_bias(speaker_inds))
+
+    def init_queues(self, n_batch, device=None):
+        """Empty dilation queues for each layer, for step"""
+        n_res = self.base_layer.out_channels
+        return [torch.zeros(n_batch, n_res, layer.queue_len(), device=device)
+                for layer in self.conv_layers]
+
+    def step_weights(self):
+        return ([self.base_layer.weight[:,:,0].t(), self.base_layer.bias,
+            self.post1.weight[:,:,0], self.post1.bias,
+            self.post2.weight[:,:,0], self.post2.bias,
+            self.cond_proj_weights()[0]],
+            [layer.step_weights() for layer in self.conv_layers])
+
+    def step(self, wav_quant, lc, cond_bias, queues, t, weights):
+        """
+        Compute one timestep of forward, for incremental generation.  Each
+        layer keeps a queue of its past inputs, so the cost of a timestep is
+        independent of the receptive field.
+        B, Q, C, P: n_batch, n_quant, n_lc_out, L * 2D
+        wav_quant: (B) input mu-law codes at time t
+        lc: (B, C) local conditioning at time t
+        cond_bias: (B, P) projected speaker conditioning, from incremental_cond
+        queues: from init_queues, updated in place
+        weights: output of step_weights()
+        returns: (B, Q) logits for the code at time t+1
+        """
+        ((base_w, base_b, post1_w, post1_b, post2_w, post2_b, lc_w),
+                layer_w) = weights
+        sig = base_w[wav_quant]
+        if base_b is not None:
+            sig = sig + base_b
+
+        cond_proj = torch.addmm(cond_bias, lc, lc_w.t())
+        cond_projs = cond_proj.chunk(len(queues), dim=1)
+        skp_sum = 0
+        for layer, queue, lw, cond_proj in zip(self.conv_layers, queues,
+                layer_w, cond_projs):
+            sig, skp = layer.step(sig, cond_proj, queue, t, lw)
+            skp_sum = skp_sum + skp
+
+        post1 = nn.functional.linear(self.relu(skp_sum), post1_w, post1_b)
+        return nn.functional.linear(self.relu(post1), post2_w, post2_b)
+
+    def generate(self, lc_sparse, speaker_inds, temperature=1.0,
+            init_quant=None, generator=None):
+        """
+        Generate mu-law codes autoregressively, one timestep at a time.
+        lc_sparse: (B, L, T2) encoded conditioning vectors
+        speaker_inds: (B) 
+        temperature: scales the logits before sampling.  0 means argmax
+        init_quant: (B) code preceding the first output.  Defaults to silence
+        returns: (B, T) mu-law codes, T determined by lc_sparse
+        """
+        with torch.no_grad():
+            lc, cond_bias = self.incremental_cond(lc_sparse, speaker_inds)
+        return self.sample(lc, cond_bias, temperature, init_quant, generator)
+
+    def sample(self, lc, cond_bias, temperature=1.0, init_quant=None,
+            generator=None):
+        """
+        Generate one mu-law code for each timestep of lc.  lc and cond_bias
+        are the outputs of incremental_cond.  See generate
+        """
+        with torch.no_grad():
+            n_batch, n_ts = lc.shape[0], lc.shape[2]
+            device = lc.device
+            if init_quant is None:
+                init_quant = torch.full((n_batch,), self.n_quant // 2,
+                        dtype=torch.long, device=device)
+            queues = self.init_queues(n_batch, device)
+            weights = self.step_weights()
+            out = torch.empty(n_batch, n_ts, dtype=torch.long, device=device)
+
+            quant = init_quant
+            for t in range(n_ts):
+                logits = self.step(quant, lc[:,:,t], cond_bias, queues, t,
+                        weights)
+                quant = self.draw(logits, temperature, generator)
+                out[:,t] = quant
+        return out
+
+    @staticmethod
+    def draw(logits, temperature, generator=None):
+        """Sample (B) codes from (B, Q) logits"""
+        if temperature == 0:
+            return logits.argmax(dim=1)
+        probs = torch.softmax(logits / temperature, dim=1)
+        return torch.multinomial(probs, 1, generator=generator).squeeze(1)
+
+    def sample_streams(self, conds, n_batch, temperature=1.0, generator=None):
+        """
+        Generate codes for many utterances of different lengths, n_batch at a
+        time.  Whenever an utterance finishes, its row of the batch is
+        reset and given to the next one from conds, so rows are never idle
+        while utterances remain.  Once none remain, finished rows are
+        dropped from the batch.
+
+        Each row holds the conditioning of its utterance and a position in
+        it, so a timestep costs the same few tensor operations regardless of
+        n_batch.  The host only intervenes when an utterance finishes, which
+        is known in advance from the lengths.
+
+        conds: iterable of (lc, cond_bias), the outputs of incremental_cond
+        for one utterance, (C, T_i) and (P).  Consumed only as rows become
+        free
+        yields: (i, quant) when the i'th utterance finishes, quant: (T_i) codes
+        """
+        with torch.no_grad():
+            conds = iter(conds)
+            first = [cond for _, cond in zip(range(n_batch), conds)]
+            if not first:
+                return
+            n_rows, n_chan = len(first), first[0][0].shape[0]
+            n_ts = max(lc.shape[1] for lc, _ in first)
+            device = first[0][0].device
+            silence = self.n_quant // 2
+
+            row_cond = first[0][0].new_zeros(n_rows, n_ts, n_chan)
+            row_bias = torch.stack([bias for _, bias in first])
+            row_out = torch.empty(n_rows, n_ts, dtype=torch.long,
+                    device=device)
+            for b, (lc, _) in enumerate(first):
+                row_cond[b,:lc.shape[1]] = lc.t()
+            row_utt = [(u, lc.shape[1]) for u, (lc, _) in enumerate(first)]
+            remaining = [lc.shape[1] for lc, _ in first]
+            n_started = n_rows
+
+            queues = self.init_queues(n_rows, device)
+            quant = torch.full((n_rows,), silence, dtype=torch.long,
+                    device=device)
+            pos = torch.zeros(n_rows, dtype=torch.long, device=device)
+            rows = torch.arange(n_rows, device=device)
+            t = 0
+
+            weights = self.step_weights()
+            while True:
+                n_steps = min(remaining)
+                for _ in range(n_steps):
+                    logits = self.step(quant, row_cond[rows, pos], row_bias,
+                            queues, t, weights)
+                    quant = self.draw(logits, temperature, generator)
+                    row_out[rows, pos] = quant
+                    pos += 1
+                    t += 1
+                remaining = [r - n_steps for r in remaining]
+
+                # Retire finished rows and admit waiting utterances
+                for b in range(len(row_utt)):
+                    if remaining[b] > 0:
+                        continue
+                    u, n_ts = row_utt[b]
+                    yield u, row_out[b,:n_ts].clone()
+                    cond = next(conds, None)
+                    if cond is None:
+                        continue
+                    lc, row_bias[b] = cond
+                    n_ts = lc.shape[1]
+                    if n_ts > row_cond.shape[1]:
+                        row_cond, row_out = self._grow_rows(row_cond,
+                                row_out, n_ts)
+                    row_cond[b,:n_ts] = lc.t()
+                    row_utt[b], remaining[b] = (n_started, n_ts), n_ts
+                    n_started += 1
+                    pos[b] = 0
+                    quant[b] = silence
+                    for queue in queues:
+                        queue[b] = 0
+
+                active = [b for b in range(len(row_utt)) if remaining[b] > 0]
+                if not active:
+                    break
+                if len(active) < len(row_utt):
+                    keep = torch.tensor(active, device=device)
+                    queues = [queue[keep] for queue in queues]
+                    row_cond, row_out = row_cond[keep], row_out[keep]
+                    row_bias = row_bias[keep]
+                    quant, pos = quant[keep], pos[keep]
+                    rows = rows[:len(active)]
+                    row_utt = [row_utt[b] for b in active]
+                    remaining = [remaining[b] for b in active]
+
+    @staticmethod
+    def _grow_rows(row_cond, row_out, n_ts):
+        """Lengthen the per-row buffers of sample_streams to n_ts timesteps"""
+        n_rows, n_old, n_chan = row_cond.shape
+        new_cond = row_cond.new_zeros(n_rows, n_ts, n_chan)
+        new_cond[:,:n_old] = row_cond
+        new_out = row_out.new_empty(n_rows, n_ts)
+        new_out[:,:n_old] = row_out
+        return new_cond, new_out